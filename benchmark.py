@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+from os.path import join
+from PIL import Image, ImageEnhance
+import PIL
+
+import dbmanager
+from summarizer import get_summary
+from matching import match_pairs, summary_matrix, synthetic_summaries, pair_set, \
+    load_fast_match, max_dist
+from find_matches import iter_image_files
+
+# Times each stage of a search and of the review on a generated collection
+# of images, so figures can be reproduced and two builds compared. Nothing
+# is downloaded and everything runs on the CPU.
+#
+#   python3 benchmark.py run --output new.json
+#   python3 benchmark.py compare old.json new.json
+
+# Bumped when the corpus or the stages change, so results from different
+# versions aren't compared.
+benchmark_version = 1
+
+# Ways a planted near-duplicate differs from its original.
+variant_kinds = ["resize", "recompress", "crop", "colour"]
+
+# A stage is a regression when it is this much slower, and by more than
+# min_regression_seconds, which keeps noise in very short stages out.
+regression_threshold = 0.15
+min_regression_seconds = 0.005
+
+def synthetic_image(rng, size):
+    # Smooth colour fields with a few hard edged shapes, which summarize and
+    # compress roughly like photos do.
+    width, height = size
+    field = rng.randint(0, 256, (6, 8, 3)).astype(np.uint8)
+    img = Image.fromarray(field, "RGB").resize(size, Image.BICUBIC)
+
+    pixels = np.asarray(img).copy()
+    for i in range(0, 6):
+        x0 = rng.randint(0, width - width // 8)
+        y0 = rng.randint(0, height - height // 8)
+        x1 = x0 + rng.randint(width // 16, width // 4)
+        y1 = y0 + rng.randint(height // 16, height // 4)
+        pixels[y0:y1, x0:x1] = rng.randint(0, 256, 3)
+
+    noise = rng.randint(-6, 7, pixels.shape)
+    pixels = np.clip(pixels.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, "RGB")
+
+def make_variant(img, kind):
+    width, height = img.size
+    if kind == "resize":
+        return img.resize((width // 2, height // 2), Image.LANCZOS), 90
+    elif kind == "recompress":
+        return img, 40
+    elif kind == "crop":
+        dx = width // 20
+        dy = height // 20
+        return img.crop((dx, dy, width - dx, height - dy)), 90
+    elif kind == "colour":
+        return ImageEnhance.Color(img).enhance(1.15), 90
+    raise ValueError("Unknown variant: %s" % (kind))
+
+def make_corpus(folder, num_images, seed=0, size=(1024, 768), near_fraction=0.2):
+    # Writes num_images JPEGs into folder, near_fraction of them variants of
+    # other images there, and returns the planted pairs as
+    # [original, variant, kind]. The same arguments always give the same
+    # files. A corpus that is already there is reused.
+    config = {"version": benchmark_version, "num_images": num_images, "seed": seed,
+        "size": list(size), "near_fraction": near_fraction}
+    manifest_path = join(folder, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["config"] == config:
+            return manifest["planted"]
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    num_near = int(num_images * near_fraction)
+    num_originals = num_images - num_near
+
+    # Subfolders, so the walk has some directories to go through.
+    originals = []
+    for i in range(0, num_originals):
+        subfolder = join(folder, "%02d" % (i % 10))
+        os.makedirs(subfolder, exist_ok=True)
+        path = join(subfolder, "img%06d.jpg" % (i))
+        synthetic_image(rng, size).save(path, "JPEG", quality=90)
+        originals.append(path)
+
+    planted = []
+    for i in range(0, num_near):
+        original = originals[rng.randint(0, num_originals)]
+        kind = variant_kinds[i % len(variant_kinds)]
+        img, quality = make_variant(Image.open(original).convert("RGB"), kind)
+        path = join(os.path.dirname(original), "near%06d_%s.jpg" % (i, kind))
+        img.save(path, "JPEG", quality=quality)
+        planted.append([original, path, kind])
+
+    with open(manifest_path, "w") as f:
+        json.dump({"config": config, "planted": planted}, f)
+    return planted
+
+def time_stage(f, repeat):
+    # Best of repeat runs, which is the least noisy figure to compare, and
+    # the result of the last.
+    best = None
+    for i in range(0, repeat):
+        t0 = time.perf_counter()
+        res = f()
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def fetch_latency(files, num_fetches):
+    # Fetches files the cache has never seen, then the same ones again.
+    # Thumbnails are off so the first fetches really decode.
+    #
+    # The image cache sets up logging and shared memory when imported, which
+    # only this stage needs.
+    import image_cache
+    image_cache.use_thumbnails = False
+    cache = image_cache.ImageCache(num_workers=1)
+    sample = files[:num_fetches]
+
+    uncached = []
+    for f in sample:
+        t0 = time.perf_counter()
+        cache.fetch(f)
+        uncached.append(time.perf_counter() - t0)
+
+    cached = []
+    for f in sample:
+        t0 = time.perf_counter()
+        cache.fetch(f)
+        cached.append(time.perf_counter() - t0)
+
+    cache.quit()
+    return uncached, cached
+
+def run(workdir, num_images=200, seed=0, repeat=3, match_size=20000, num_fetches=20):
+    # cache.db is opened in the current directory, so the benchmark runs in
+    # workdir and never touches the real cache.
+    workdir = os.path.abspath(workdir)
+    corpus = join(workdir, "corpus")
+    print("Preparing corpus of %d images in %s" % (num_images, corpus))
+    planted = make_corpus(corpus, num_images, seed)
+
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    stages = {}
+
+    def record(name, seconds, items):
+        stages[name] = {"seconds": seconds, "items": items,
+            "ms_per_item": 1000.0 * seconds / max(items, 1)}
+        print("%-16s %9.3f s  %9.3f ms each (%d)" % (name, seconds,
+            stages[name]["ms_per_item"], items))
+
+    try:
+        seconds, files = time_stage(lambda: sorted(iter_image_files(corpus)), repeat)
+        record("walk", seconds, len(files))
+
+        def cold_load():
+            for name in ["cache.db", "cache.db-wal", "cache.db-shm"]:
+                if os.path.exists(name):
+                    os.remove(name)
+            return dbmanager.load(files, report=False)
+        seconds, res = time_stage(cold_load, repeat)
+        record("cache_load_cold", seconds, len(files))
+
+        seconds, summaries = time_stage(
+            lambda: dict((f, get_summary(f)) for f in files), repeat)
+        record("decode_summary", seconds, len(files))
+
+        bad_files = set(f for f in files if summaries[f] is None)
+        good = [f for f in files if not f in bad_files]
+        seconds, res = time_stage(lambda: dbmanager.update(good, summaries, bad_files), repeat)
+        record("cache_write", seconds, len(files))
+
+        seconds, res = time_stage(lambda: dbmanager.load(files, report=False), repeat)
+        record("cache_load_warm", seconds, len(files))
+
+        engine = "fast_match" if load_fast_match() is not None else "numpy"
+        matrix = summary_matrix(good, summaries)
+        seconds, matches = time_stage(lambda: match_pairs(matrix, max_dist), repeat)
+        record("match_corpus", seconds, len(good))
+
+        # Matching only dominates on collections far bigger than is practical
+        # to generate images for, so it is also run on synthetic summaries.
+        matrix = synthetic_summaries(match_size, seed)
+        seconds, res = time_stage(lambda: match_pairs(matrix, max_dist), repeat)
+        record("match_synthetic", seconds, match_size)
+
+        uncached, cached = fetch_latency(good, num_fetches)
+        record("fetch_uncached", sum(uncached), len(uncached))
+        record("fetch_cached", sum(cached), len(cached))
+    finally:
+        os.chdir(old_cwd)
+
+    # Which planted pairs were matched, by kind of change.
+    index = dict((f, i) for i, f in enumerate(good))
+    found = pair_set(matches)
+    recall = {}
+    for kind in variant_kinds:
+        pairs = [p for p in planted if p[2] == kind and p[0] in index and p[1] in index]
+        hits = 0
+        for original, variant, kind in pairs:
+            i, j = sorted([index[original], index[variant]])
+            if (i, j) in found:
+                hits = hits + 1
+        recall[kind] = hits / max(len(pairs), 1)
+
+    return {
+        "version": benchmark_version,
+        "config": {"num_images": num_images, "seed": seed, "repeat": repeat,
+            "match_size": match_size, "num_fetches": num_fetches},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "engine": engine,
+        },
+        "stages": stages,
+        "latency": {
+            "fetch_uncached_p50_ms": 1000.0 * percentile(uncached, 0.5),
+            "fetch_uncached_p90_ms": 1000.0 * percentile(uncached, 0.9),
+            "fetch_cached_p50_ms": 1000.0 * percentile(cached, 0.5),
+            "fetch_cached_p90_ms": 1000.0 * percentile(cached, 0.9),
+        },
+        "matches": len(found),
+        "recall": recall,
+    }
+
+def compare(old, new, threshold=regression_threshold):
+    # Prints each stage of two runs side by side and returns the names of
+    # those that got slower by more than threshold. Lower recall on planted
+    # pairs counts as a regression too.
+    if old["version"] != new["version"] or old["config"] != new["config"]:
+        print("Warning: runs used different settings, times may not be comparable")
+    if old["environment"] != new["environment"]:
+        print("Warning: runs were on different environments")
+
+    regressions = []
+    print("%-16s %10s %10s %8s" % ("stage", "old (s)", "new (s)", "change"))
+    for name in new["stages"]:
+        if not name in old["stages"]:
+            continue
+        before = old["stages"][name]["seconds"]
+        after = new["stages"][name]["seconds"]
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > threshold and after - before > min_regression_seconds:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("%-16s %10.3f %10.3f %+7.1f%%%s" % (name, before, after, 100 * change, flag))
+
+    for kind in new["recall"]:
+        before = old["recall"].get(kind)
+        after = new["recall"][kind]
+        if before is not None and after < before:
+            print("Recall of %s pairs fell from %.3f to %.3f  REGRESSION" % (kind, before, after))
+            regressions.append("recall_" + kind)
+
+    return regressions
+
+def test_benchmark():
+    # A tiny run, its corpus generated twice to check it is deterministic,
+    # and a comparison against a slowed down copy.
+    with tempfile.TemporaryDirectory() as workdir:
+        first = make_corpus(join(workdir, "a"), 20, seed=3, size=(320, 240))
+        second = make_corpus(join(workdir, "b"), 20, seed=3, size=(320, 240))
+        for (a, b) in zip(first, second):
+            with open(a[1], "rb") as fa, open(b[1], "rb") as fb:
+                assert fa.read() == fb.read()
+
+        result = run(workdir, num_images=20, repeat=1, match_size=2000, num_fetches=4)
+        assert set(result["stages"]) == set(["walk", "cache_load_cold", "decode_summary",
+            "cache_write", "cache_load_warm", "match_corpus", "match_synthetic",
+            "fetch_uncached", "fetch_cached"])
+        assert result["stages"]["walk"]["items"] == 20
+        print("Recall:", result["recall"])
+
+        assert compare(result, result) == []
+        slower = json.loads(json.dumps(result))
+        slower["stages"]["decode_summary"]["seconds"] *= 2
+        slower["stages"]["walk"]["seconds"] *= 1.01
+        assert compare(result, slower) == ["decode_summary"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage on a generated image collection.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Time every stage")
+    run_parser.add_argument("--images", type=int, default=200,
+        help="Images in the generated collection (default %(default)s)")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeat", type=int, default=3,
+        help="Runs of each stage, the fastest is kept (default %(default)s)")
+    run_parser.add_argument("--match-size", type=int, default=20000,
+        help="Synthetic summaries matched in the match_synthetic stage (default %(default)s)")
+    run_parser.add_argument("--fetches", type=int, default=20,
+        help="Files fetched through the image cache (default %(default)s)")
+    run_parser.add_argument("--workdir", default=None,
+        help="Where the collection and its cache are kept, so later runs "
+        "reuse them (default a temporary folder)")
+    run_parser.add_argument("--output", default=None, help="Save the results as JSON")
+
+    compare_parser = commands.add_parser("compare",
+        help="Compare two saved runs, exits with 1 if the second regressed")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=regression_threshold,
+        help="Slowdown counted as a regression (default %(default)s)")
+
+    commands.add_parser("test", help="Check the benchmark itself on a tiny run")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        workdir = args.workdir
+        if workdir is None:
+            workdir = tempfile.mkdtemp(prefix="benchmark_")
+        result = run(workdir, args.images, args.seed, args.repeat, args.match_size, args.fetches)
+        print(json.dumps(result["latency"], indent=1))
+        print("Recall of planted pairs:", result["recall"])
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=1)
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if len(compare(old, new, args.threshold)) > 0:
+            sys.exit(1)
+    elif args.command == "test":
+        test_benchmark()
@@ -1,36 +1,219 @@
 import sqlite3
 import numpy as np
 import hashlib
+import os
 
 # Create table
 arrsize = 192
 
+# Version 1 stored each summary as 192 real columns, version 2 stores it as a
+# single float32 blob, version 3 adds the file's size, mtime, inode and
+# fingerprint, version 4 adds the stored match results, version 5 adds a hash
+# of the whole file. The version is kept in PRAGMA user_version.
+schema_version = 5
+summary_dtype = np.float32
+
+# Rows copied per transaction while migrating, so an interrupted migration
+# keeps its progress and carries on the next time the cache is opened.
+migrate_batch_size = 10000
+
+def table_columns(c, table):
+    c.execute("PRAGMA table_info(%s)" % (table))
+    return [row[1] for row in c.fetchall()]
+
+def migrate_v1(c):
+    conn = c.connection
+
+    # Move the old table aside so the new layout can take its name.
+    if "s0" in table_columns(c, "summaries"):
+        c.execute("ALTER TABLE summaries RENAME TO summaries_v1")
+        conn.commit()
+
+    if len(table_columns(c, "summaries_v1")) == 0:
+        return
+
+    c.execute('CREATE TABLE IF NOT EXISTS summaries(filename text primary key, summary blob)')
+    print("Migrating summary cache to schema version %d" % (schema_version))
+
+    while True:
+        c.execute("SELECT rowid, * FROM summaries_v1 LIMIT ?", (migrate_batch_size,))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            break
+
+        c.executemany("INSERT OR IGNORE INTO summaries(filename, summary) VALUES (?, ?)",
+            ((row[1], encode(row[2:])) for row in rows))
+        c.executemany("DELETE FROM summaries_v1 WHERE rowid=?",
+            ((row[0],) for row in rows))
+        conn.commit()
+
+    c.execute("DROP TABLE summaries_v1")
+    conn.commit()
+
+    # Give the space used by the old layout back to the filesystem.
+    c.execute("VACUUM")
+
+def migrate_v2(c):
+    # Rows from older versions get NULL stats. load trusts such a summary
+    # once and fills them in, and tries such a bad file again.
+    columns = table_columns(c, "summaries")
+    for name, kind in [("size", "integer"), ("mtime", "integer"),
+            ("inode", "integer"), ("fingerprint", "blob")]:
+        if name not in columns:
+            c.execute("ALTER TABLE summaries ADD COLUMN %s %s" % (name, kind))
+
+    columns = table_columns(c, "badfiles")
+    for name in ["size", "mtime", "inode"]:
+        if name not in columns:
+            c.execute("ALTER TABLE badfiles ADD COLUMN %s integer" % (name))
+
+def migrate_v4(c):
+    # Hashes are filled in as files are read in full.
+    if not "full_hash" in table_columns(c, "summaries"):
+        c.execute("ALTER TABLE summaries ADD COLUMN full_hash blob")
+
 def initialize(c):
-    arr_fields = []
-    for i in range(0, arrsize):
-        arr_fields.append("s%d real"%(i))
-    fieldstr = ", ".join(arr_fields)
+    # Lets the cache be read while a scan is writing to it.
+    c.execute("PRAGMA journal_mode=WAL")
+
+    c.execute("PRAGMA user_version")
+    version = c.fetchone()[0]
+
+    if version < 2:
+        migrate_v1(c)
+
+    c.execute('CREATE TABLE IF NOT EXISTS summaries(filename text primary key, summary blob, '
+        'size integer, mtime integer, inode integer, fingerprint blob, full_hash blob)')
+    c.execute('CREATE TABLE IF NOT EXISTS badfiles(filename text primary key, '
+        'size integer, mtime integer, inode integer)')
 
-    c.execute('CREATE TABLE IF NOT EXISTS summaries(filename text primary key, '+fieldstr + ')')
-    c.execute('CREATE TABLE IF NOT EXISTS badfiles(filename text primary key)')
+    if version < 3:
+        migrate_v2(c)
+    if version < 5:
+        migrate_v4(c)
 
-def hash(filename):
-    return hashlib.sha256(bytes(filename, encoding = 'utf-8')).digest()
+    c.execute('CREATE INDEX IF NOT EXISTS summaries_fingerprint ON summaries(fingerprint)')
+
+    # Pairs found by the last match, and a digest of each summary it was run
+    # over, so the next run only has to compare new or changed files.
+    c.execute('CREATE TABLE IF NOT EXISTS match_files(filename text primary key, digest blob)')
+    c.execute('CREATE TABLE IF NOT EXISTS matches(left_file text, right_file text, distance real)')
+    c.execute('CREATE INDEX IF NOT EXISTS matches_left ON matches(left_file)')
+    c.execute('CREATE INDEX IF NOT EXISTS matches_right ON matches(right_file)')
+    c.execute('CREATE TABLE IF NOT EXISTS match_state(key text primary key, value)')
+
+    if version < schema_version:
+        c.execute("PRAGMA user_version = %d" % (schema_version))
+        c.connection.commit()
+
+def encode(summary):
+    # Quantized summaries are stored as they are, one byte per value.
+    summary = np.asarray(summary)
+    if summary.dtype == np.uint8:
+        return summary.tobytes()
+    return np.asarray(summary, dtype=summary_dtype).tobytes()
+
+def decode_all(blobs):
+    # One copy of all blobs into a single matrix, returned as row views. The
+    # blob length tells quantized summaries apart, and a mix of both kinds is
+    # decoded one by one.
+    sizes = set(len(b) for b in blobs)
+    if len(sizes) > 1:
+        return [decode_all([b])[0] for b in blobs]
+    dtype = np.uint8 if sizes == set([arrsize]) else summary_dtype
+    data = np.frombuffer(b"".join(blobs), dtype=dtype)
+    return data.reshape(-1, arrsize)
+
+def file_stat(filename):
+    # (size, mtime_ns, inode), or None if the file can't be read.
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+fingerprint_chunk = 16 * 1024
+
+def fingerprint(filename, size):
+    # Size plus a hash of the first and last chunks of the file. This is
+    # enough to recognise a moved or copied image without reading all of it.
+    h = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=16)
+    try:
+        with open(filename, "rb") as f:
+            h.update(f.read(fingerprint_chunk))
+            if size > fingerprint_chunk:
+                f.seek(max(fingerprint_chunk, size - fingerprint_chunk))
+                h.update(f.read(fingerprint_chunk))
+    except OSError as e:
+        return None
+    return h.digest()
+
+hash_block_size = 1024 * 1024
+
+def full_hash(filename):
+    h = hashlib.blake2b(digest_size=32)
+    try:
+        with open(filename, "rb") as f:
+            while True:
+                block = f.read(hash_block_size)
+                if not block:
+                    break
+                h.update(block)
+    except OSError as e:
+        return None
+    return h.digest()
+
+# Columns of a summaries row, in the order they are inserted.
+insert_summary = ("INSERT OR REPLACE INTO summaries(filename, summary, size, mtime, inode, "
+    "fingerprint, full_hash) VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+def update_hashes(c, rows):
+    # rows are (full_hash, filename, size, mtime, inode). A hash is only
+    # stored while the file's entry has the stats it was computed for.
+    c.executemany("UPDATE summaries SET full_hash=? "
+        "WHERE filename=? AND size=? AND mtime=? AND inode=?", rows)
+
+def update(new_files, summaries, bad_files, fingerprints=None, hashes=None):
+    # fingerprints and hashes have those already computed, so files aren't
+    # read again for them. hashes may also have files written earlier.
+    if fingerprints is None:
+        fingerprints = {}
+    if hashes is None:
+        hashes = {}
 
-def update(new_files, summaries, bad_files):
     conn = sqlite3.connect('cache.db')
     c = conn.cursor()
     initialize(c)
 
-    field_str = "INSERT OR IGNORE INTO summaries VALUES (?"+ ", ?"*arrsize +")"
+    # With WAL, commits survive a crash of this process without an fsync
+    # each, so frequent small commits during a scan stay cheap.
+    c.execute("PRAGMA synchronous=NORMAL")
 
+    rows = []
     for filename in new_files:
-        list_summary = summaries[filename].tolist()
-        values = [filename] + list_summary
-        c.execute(field_str, (values))
+        st = file_stat(filename)
+        if st is None:
+            continue
+        fp = fingerprints.get(filename)
+        if fp is None:
+            fp = fingerprint(filename, st[0])
+        rows.append((filename, encode(summaries[filename])) + st + (fp, hashes.get(filename)))
+
+    c.executemany(insert_summary, rows)
+
+    written = set(new_files)
+    hash_rows = []
+    for filename, digest in hashes.items():
+        st = file_stat(filename)
+        if not filename in written and st is not None:
+            hash_rows.append((digest, filename) + st)
+    update_hashes(c, hash_rows)
 
     for filename in bad_files:
-        c.execute("INSERT OR IGNORE INTO badfiles VALUES (?)", (filename,))
+        # A file that is gone isn't recorded, it is tried again if it returns.
+        st = file_stat(filename)
+        if st is not None:
+            c.execute("INSERT OR REPLACE INTO badfiles VALUES (?, ?, ?, ?)", (filename,) + st)
 
     conn.commit()
 
@@ -38,33 +221,249 @@ def update(new_files, summaries, bad_files):
     # Just be sure any changes have been committed or they will be lost.
     conn.close()
 
-def load(files):
+def load(files, report=True):
     conn = sqlite3.connect('cache.db')
     c = conn.cursor()
+    initialize(c)
     summaries = {}
     bad_files = set([])
 
-    found = 0
-    missed = 0
+    # Fingerprints of the files that still need to be summarized, and the
+    # full hashes of those that had to be read in full.
+    fingerprints = {}
+    hashes = {}
+
+    counts = {"found": 0, "reused": 0, "recomputed": 0, "new": 0, "bad": 0}
     try:
+        # Join against a temporary table of the requested paths instead of
+        # running one or two SELECTs per file.
+        c.execute("CREATE TEMP TABLE requested(filename text primary key)")
+        c.executemany("INSERT OR IGNORE INTO requested VALUES (?)",
+            ((f,) for f in files))
+
+        c.execute("SELECT filename, size, mtime, inode, fingerprint, summary "
+            "FROM summaries JOIN requested USING (filename)")
+        rows = c.fetchall()
+        matrix = decode_all([vals[5] for vals in rows])
+        cached = {}
+        for vals, summary in zip(rows, matrix):
+            cached[vals[0]] = (vals[1:4], vals[4], summary)
+
+        c.execute("SELECT filename, size, mtime, inode "
+            "FROM badfiles JOIN requested USING (filename)")
+        known_bad = {}
+        for vals in c:
+            known_bad[vals[0]] = vals[1:4]
+
+        # Entries whose stats are missing or changed but whose content still
+        # matches, as (size, mtime, inode, fingerprint, filename).
+        refreshed = []
+        # Files without a valid entry, as filename -> (stat, fingerprint, stale).
+        unmatched = {}
+
         for f in files:
-            c.execute("SELECT * FROM summaries WHERE filename=?", (f,))
-            vals = c.fetchone()
-            if not vals is None:
-                summary_vals = vals[1:]
-                summaries[f] = np.array(summary_vals)
-                found = found + 1
-            else:
-                # Check if this is known to be missing.
-                c.execute("SELECT * FROM badfiles WHERE filename=?", (f,))
-                vals = c.fetchone()
-                if vals is None:
-                    missed = missed + 1
+            st = file_stat(f)
+            entry = cached.get(f)
+            if not entry is None:
+                stored_stat, stored_fp, summary = entry
+                if stored_stat == st:
+                    summaries[f] = summary
+                    counts["found"] = counts["found"] + 1
+                    continue
+
+                fp = None
+                if st is not None:
+                    fp = fingerprint(f, st[0])
+
+                # The fingerprint doesn't cover the whole file, so it is only
+                # trusted when the file wasn't modified, such as when it was
+                # restored with its mtime and got a new inode.
+                same_mtime = st is not None and st[1] == stored_stat[1]
+                if fp is not None and (stored_stat[0] is None or (fp == stored_fp and same_mtime)):
+                    # Entry from an older schema, or only the inode changed.
+                    summaries[f] = summary
+                    counts["found"] = counts["found"] + 1
+                    refreshed.append(st + (fp, f))
                 else:
+                    unmatched[f] = (st, fp, True)
+            elif f in known_bad:
+                stored_stat = known_bad[f]
+                if stored_stat == st:
                     bad_files.add(f)
+                else:
+                    unmatched[f] = (st, None, True)
+            else:
+                fp = None
+                if st is not None:
+                    fp = fingerprint(f, st[0])
+                unmatched[f] = (st, fp, False)
+
+        # A file whose fingerprint is already cached under another path may
+        # have been moved or copied. Its summary is reused if the other path
+        # is gone and the file kept its size and mtime, as a move does, or if
+        # both files are unchanged and have the same contents.
+        c.execute("CREATE TEMP TABLE wanted(fingerprint blob primary key)")
+        c.executemany("INSERT OR IGNORE INTO wanted VALUES (?)",
+            ((fp,) for st, fp, stale in unmatched.values() if fp is not None))
+        c.execute("SELECT fingerprint, filename, size, mtime, inode, summary, full_hash "
+            "FROM summaries JOIN wanted USING (fingerprint)")
+        by_fingerprint = {}
+        for vals in c.fetchall():
+            by_fingerprint.setdefault(vals[0], []).append(
+                (vals[1], vals[2:5], vals[5], vals[6]))
 
-        print("Found %d, missed %d, bad %d" % (found, missed, len(bad_files)))
+        reused = []
+        # Hashes of unchanged sources that weren't stored yet, with their stats.
+        source_hashes = {}
+        for f, (st, fp, stale) in unmatched.items():
+            blob = None
+            digest = None
+            for source, source_stat, source_blob, source_hash in by_fingerprint.get(fp, []):
+                if source == f:
+                    continue
+                source_now = file_stat(source)
+                if source_now is None:
+                    if st is not None and tuple(source_stat[0:2]) == st[0:2]:
+                        blob = source_blob
+                        break
+                    continue
+                if source_now != tuple(source_stat):
+                    continue
+                if digest is None:
+                    digest = full_hash(f)
+                if source_hash is None:
+                    if not source in source_hashes:
+                        source_hashes[source] = (full_hash(source), source_now)
+                    source_hash = source_hashes[source][0]
+                if digest is not None and digest == source_hash:
+                    blob = source_blob
+                    break
+
+            if blob is not None:
+                summaries[f] = decode_all([blob])[0]
+                counts["reused"] = counts["reused"] + 1
+                reused.append((f, blob) + st + (fp, digest))
+            else:
+                fingerprints[f] = fp
+                if digest is not None:
+                    hashes[f] = digest
+                if stale:
+                    counts["recomputed"] = counts["recomputed"] + 1
+                else:
+                    counts["new"] = counts["new"] + 1
+
+        # The full hash was only confirmed for the old stats.
+        c.executemany("UPDATE summaries SET size=?, mtime=?, inode=?, fingerprint=?, "
+            "full_hash=NULL WHERE filename=?", refreshed)
+        c.executemany(insert_summary, reused)
+        update_hashes(c, [(digest, source) + st
+            for source, (digest, st) in source_hashes.items() if digest is not None])
+        conn.commit()
+
+        counts["bad"] = len(bad_files)
+        if report:
+            print("Found %d, reused %d, changed %d, new %d, bad %d" % (counts["found"],
+                counts["reused"], counts["recomputed"], counts["new"], counts["bad"]))
     except sqlite3.OperationalError as e:
         pass
 
-    return summaries, bad_files
+    conn.close()
+    return summaries, bad_files, counts, fingerprints, hashes
+
+def summary_digest(summary):
+    return hashlib.blake2b(encode(summary), digest_size=16).digest()
+
+def load_matches():
+    # Returns the radius of the stored match (None if there isn't one), the
+    # summary digest of each file it covered and its pairs as
+    # (left_file, right_file, distance).
+    conn = sqlite3.connect('cache.db')
+    c = conn.cursor()
+    initialize(c)
+
+    c.execute("SELECT value FROM match_state WHERE key='radius'")
+    row = c.fetchone()
+    radius = None
+    if row is not None:
+        radius = row[0]
+
+    c.execute("SELECT filename, digest FROM match_files")
+    digests = dict(c.fetchall())
+
+    c.execute("SELECT left_file, right_file, distance FROM matches")
+    pairs = c.fetchall()
+
+    conn.close()
+    return radius, digests, pairs
+
+def save_matches(radius, digests, dropped_files, scores, full):
+    # Records the pairs in scores ([distance, left_file, right_file]) found
+    # for the files in digests. With full, they replace everything stored,
+    # otherwise the files in dropped_files and their pairs are removed first.
+    conn = sqlite3.connect('cache.db')
+    c = conn.cursor()
+    initialize(c)
+
+    if full:
+        c.execute("DELETE FROM matches")
+        c.execute("DELETE FROM match_files")
+    else:
+        dropped = [(f,) for f in dropped_files]
+        c.executemany("DELETE FROM matches WHERE left_file=?", dropped)
+        c.executemany("DELETE FROM matches WHERE right_file=?", dropped)
+        c.executemany("DELETE FROM match_files WHERE filename=?", dropped)
+
+    c.executemany("INSERT OR REPLACE INTO match_files VALUES (?, ?)", digests.items())
+    c.executemany("INSERT INTO matches VALUES (?, ?, ?)",
+        ((s[1], s[2], s[0]) for s in scores))
+    c.execute("INSERT OR REPLACE INTO match_state VALUES ('radius', ?)", (radius,))
+
+    conn.commit()
+    conn.close()
+
+def load_fingerprints(files):
+    # (size, fingerprint) of each file with a cached summary.
+    conn = sqlite3.connect('cache.db')
+    c = conn.cursor()
+    initialize(c)
+
+    c.execute("CREATE TEMP TABLE requested(filename text primary key)")
+    c.executemany("INSERT OR IGNORE INTO requested VALUES (?)", ((f,) for f in files))
+    c.execute("SELECT filename, size, fingerprint FROM summaries JOIN requested USING (filename)")
+
+    result = {}
+    for vals in c:
+        if vals[1] is not None and vals[2] is not None:
+            result[vals[0]] = (vals[1], vals[2])
+
+    conn.close()
+    return result
+
+def load_hashes(files):
+    # Stored full hashes of files that haven't changed since they were
+    # hashed.
+    conn = sqlite3.connect('cache.db')
+    c = conn.cursor()
+    initialize(c)
+
+    c.execute("CREATE TEMP TABLE requested(filename text primary key)")
+    c.executemany("INSERT OR IGNORE INTO requested VALUES (?)", ((f,) for f in files))
+    c.execute("SELECT filename, size, mtime, inode, full_hash FROM summaries "
+        "JOIN requested USING (filename) WHERE full_hash IS NOT NULL")
+    rows = c.fetchall()
+    conn.close()
+
+    result = {}
+    for vals in rows:
+        if file_stat(vals[0]) == tuple(vals[1:4]):
+            result[vals[0]] = vals[4]
+    return result
+
+def save_hashes(hashes):
+    # hashes maps files to (stat, full_hash), the stat taken before reading.
+    conn = sqlite3.connect('cache.db')
+    c = conn.cursor()
+    initialize(c)
+    update_hashes(c, [(digest, f) + st for f, (st, digest) in hashes.items()])
+    conn.commit()
+    conn.close()
@@ -1,6 +1,5 @@
 from PIL import Image
 from math import ceil
-from io import BytesIO
 import json
 from os.path import join, getsize
 import os
@@ -9,19 +8,22 @@ import sys
 from pprint import pprint
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GdkPixbuf
-from image_cache import ImageCache
+from gi.repository import Gtk, GdkPixbuf, GLib
+from image_cache import ImageCache, canvas_size
+from prefetch import PrefetchScheduler
 
 def pil_to_pixbuf(pilimage):
-    buff = BytesIO()
-    pilimage.save(buff, 'ppm')
-    contents = buff.getvalue()
-    buff.close()
-    loader = GdkPixbuf.PixbufLoader.new_with_type('pnm')
-    loader.write(contents)
-    pixbuf = loader.get_pixbuf()
-    loader.close()
-    return pixbuf
+    # Canvases are raw RGB rows, which is already the pixbuf layout, so the
+    # pixels are copied instead of being encoded and parsed. They are copied
+    # twice, out of the cache slot by tobytes and into memory GLib owns by
+    # GLib.Bytes.new. The pixbuf has to own its pixels anyway since cache
+    # slots get reused.
+    if pilimage.mode != "RGB":
+        pilimage = pilimage.convert("RGB")
+    width, height = pilimage.size
+    data = GLib.Bytes.new(pilimage.tobytes())
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+        False, 8, width, height, width * 3)
 
 class DialogExample(Gtk.Dialog):
     def __init__(self, parent):
@@ -45,37 +47,47 @@ class Handler:
         self.page_count = len(scores)
         self.scores = scores
         self.builder = builder
-        self.cache = ImageCache(num_workers=16, max_cache_size=40)
+        self.cache = ImageCache(num_workers=16)
+        self.prefetch = PrefetchScheduler(self.cache.capacity())
         self.update_page()
 
     def cache_nearby(self, pagenum):
-        filenames = []
-
-        for i in range(pagenum, pagenum + 10):
-            if i > 0 and i < len(self.scores):
-                leftfile = self.scores[i][1]
-                rightfile = self.scores[i][2]
-                filenames.append(leftfile)
-                filenames.append(rightfile)
-
-        for i in range(pagenum - 5, pagenum):
-            if i > 0 and i < len(self.scores):
-                leftfile = self.scores[i][1]
-                rightfile = self.scores[i][2]
-                filenames.append(leftfile)
-                filenames.append(rightfile)
+        # Every call replaces the last preload, so files that fell out of the
+        # window stop loading.
+        self.prefetch.moved_to(pagenum, len(self.scores))
 
+        filenames = []
+        for i in self.prefetch.schedule(len(self.scores)):
+            leftfile = self.scores[i][1]
+            rightfile = self.scores[i][2]
+            filenames.append(leftfile)
+            filenames.append(rightfile)
+
+        # The cache wants the most important file last.
+        filenames.reverse()
         self.cache.preload(filenames)
 
     def get_image(self, pagenum):
         left_file = self.scores[self.page_num][1]
         right_file = self.scores[self.page_num][2]
 
-        left_image = self.cache.fetch(left_file)
-        right_image = self.cache.fetch(right_file)
-        left_image['pixbuf'] = pil_to_pixbuf(left_image['canvas'])
-        right_image['pixbuf'] = pil_to_pixbuf(right_image['canvas'])
-        return left_image, right_image
+        images = self.cache.fetch_all([left_file, right_file])
+        for i in range(0, len(images)):
+            if images[i] is None:
+                # Missing or unreadable, shown as a blank canvas.
+                images[i] = {"canvas": Image.new("RGB", canvas_size, "white")}
+            images[i]['pixbuf'] = pil_to_pixbuf(images[i]['canvas'])
+        return images[0], images[1]
+
+    def describe(self, filename, image, other):
+        if not "width" in image:
+            return "%s\nCould not be loaded\n" % (filename)
+
+        description = "%s\nWidth: %d\nHeight: %d\nFilesize: %d\n" % (
+            filename, image["width"], image["height"], image["filesize"])
+        if "filesize" in other and image["filesize"] > other["filesize"]:
+            description = description + "(Larger)\n"
+        return description
 
     def update_page(self):
         if(len(self.scores) == 0):
@@ -109,10 +121,7 @@ class Handler:
         self.cache_nearby(self.page_num)
 
         # update right
-        right_description = "%s\nWidth: %d\nHeight: %d\nFilesize: %d\n" % (
-            right_file, right_image["width"], right_image["height"], right_image["filesize"])
-        if(right_image["filesize"] > left_image["filesize"]):
-            right_description = right_description + "(Larger)\n"
+        right_description = self.describe(right_file, right_image, left_image)
 
         right_buffer = Gtk.TextBuffer()
         right_buffer.set_text(right_description)
@@ -120,10 +129,7 @@ class Handler:
         textview2.set_buffer(right_buffer)
 
         # update left
-        left_description = "%s\nWidth: %d\nHeight: %d\nFilesize: %d\n" % (
-            left_file, left_image["width"], left_image["height"], left_image["filesize"])
-        if(left_image["filesize"] > right_image["filesize"]):
-            left_description = left_description + "(Larger)\n"
+        left_description = self.describe(left_file, left_image, right_image)
 
         left_buffer = Gtk.TextBuffer()
         left_buffer.set_text(left_description)
@@ -0,0 +1,68 @@
+import hashlib
+from collections import defaultdict
+import dbmanager
+from dbmanager import full_hash
+
+def find_exact_duplicates(files):
+    # Groups of byte-identical files, each in the order of files. Files are
+    # grouped by size and then by the cached fingerprint (a hash of the first
+    # and last chunks), so only files that still collide are read in full,
+    # and only if their full hash isn't cached already.
+    fingerprints = dbmanager.load_fingerprints(files)
+
+    by_fingerprint = defaultdict(list)
+    for f in files:
+        key = fingerprints.get(f)
+        if key is not None:
+            by_fingerprint[key].append(f)
+
+    groups = []
+    colliding = []
+    for (size, fp), candidates in by_fingerprint.items():
+        if len(candidates) < 2:
+            continue
+
+        # Small files are covered entirely by the fingerprint.
+        if size <= 2 * dbmanager.fingerprint_chunk:
+            groups.append(candidates)
+        else:
+            colliding.append(candidates)
+
+    hashes = dbmanager.load_hashes([f for candidates in colliding for f in candidates])
+    new_hashes = {}
+    for candidates in colliding:
+        by_hash = defaultdict(list)
+        for f in candidates:
+            digest = hashes.get(f)
+            if digest is None:
+                st = dbmanager.file_stat(f)
+                digest = full_hash(f)
+                if st is not None and digest is not None:
+                    new_hashes[f] = (st, digest)
+            if digest is not None:
+                by_hash[digest].append(f)
+
+        for group in by_hash.values():
+            if len(group) > 1:
+                groups.append(group)
+
+    dbmanager.save_hashes(new_hashes)
+
+    copies = sum(len(group) - 1 for group in groups)
+    print("Found %d groups of identical files, with %d extra copies" % (len(groups), copies))
+    return groups
+
+def unique_files(files, groups):
+    # files without the extra copies, keeping the first file of each group.
+    copies = set([])
+    for group in groups:
+        copies.update(group[1:])
+    return [f for f in files if not f in copies]
+
+def exact_scores(groups):
+    # Each copy paired with the first file of its group, at distance 0.
+    scores = []
+    for group in groups:
+        for f in group[1:]:
+            scores.append([0.0, group[0], f])
+    return scores
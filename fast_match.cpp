@@ -1,16 +1,15 @@
-#include <fstream>
-#include <iostream>
+#include <algorithm>
+#include <utility>
 #include <cstdlib>
 #include <cmath>
 #include <thread>
 #include <vector>
-#include <string>
 #include <math.h>
 #include <immintrin.h>
 
 #define NUM_THREADS 8
 #define ARR_SIZE 192
-#define val(filenum,i) (data[ARR_SIZE*filenum + i])
+#define API_VERSION 2
 
 struct match
 {
@@ -19,12 +18,32 @@ struct match
     float distance;
 };
 
-inline float norm(const float* x, const float* y)
+inline float horizontal_sum(__m256 eight_sums)
+{
+    //Convert 8sum into a 4sum
+    __m128 four_left_regs = _mm256_extractf128_ps(eight_sums, 0);
+    __m128 four_right_regs = _mm256_extractf128_ps(eight_sums, 1);
+    __m128 four_sums = _mm_add_ps(four_left_regs, four_right_regs);
+    //Convert 4sum into a 1sum
+    __m128 two_sums_padded = _mm_hadd_ps(four_sums, four_sums);
+    __m128 one_sum_padded = _mm_hadd_ps(two_sums_padded, two_sums_padded);
+    return _mm_cvtss_f32(one_sum_padded);
+}
+
+inline int horizontal_sum(__m128i sums)
+{
+    sums = _mm_add_epi32(sums, _mm_shuffle_epi32(sums, _MM_SHUFFLE(1, 0, 3, 2)));
+    sums = _mm_add_epi32(sums, _mm_shuffle_epi32(sums, _MM_SHUFFLE(2, 3, 0, 1)));
+    return _mm_cvtsi128_si32(sums);
+}
+
+// Sum of squared differences of two vectors of SIZE floats, a multiple of 8.
+template<int SIZE>
+inline float sum_of_squares(const float* x, const float* y)
 {
-    float sum_of_squares;
     //Add the vectors 8 at a time. Don't need to check for remainder.
     __m256 eight_sums = _mm256_setzero_ps();
-    for (int n = ARR_SIZE; n>=8; n-=8){
+    for (int n = SIZE; n>=8; n-=8){
         const __m256 a = _mm256_loadu_ps(x);
         const __m256 b = _mm256_loadu_ps(y);
         const __m256 a_minus_b = _mm256_sub_ps(a,b);
@@ -33,89 +52,634 @@ inline float norm(const float* x, const float* y)
         x+=8;
         y+=8;
     }
+    return horizontal_sum(eight_sums);
+}
 
-    //Convert 8sum into a 4sum
-    __m128 four_left_regs = _mm256_extractf128_ps(eight_sums, 0);
-    __m128 four_right_regs = _mm256_extractf128_ps(eight_sums, 1);
-    __m128 four_sums = _mm_add_ps(four_left_regs, four_right_regs);
-    //Convert 4sum into a 1sum
-    __m128 two_sums_padded = _mm_hadd_ps(four_sums, four_sums);
-    __m128 one_sum_padded = _mm_hadd_ps(two_sums_padded, two_sums_padded);
-    sum_of_squares = _mm_cvtss_f32(one_sum_padded);
-    return sqrt(sum_of_squares);
+// The full distance gives up once the sum of squares so far reaches
+// limit_squared, checking every ABANDON_STRIDE values. Squares are never
+// negative, so the full sum could only be larger. Returns whether it got to
+// the end, with the distance in *dist.
+#define ABANDON_STRIDE 48
+
+inline bool bounded_norm(const float* x, const float* y, float limit_squared, float* dist)
+{
+    __m256 eight_sums = _mm256_setzero_ps();
+    for (int n = 8; n <= ARR_SIZE; n+=8){
+        const __m256 a = _mm256_loadu_ps(x);
+        const __m256 b = _mm256_loadu_ps(y);
+        const __m256 a_minus_b = _mm256_sub_ps(a,b);
+        const __m256 a_minus_b_squared = _mm256_mul_ps(a_minus_b, a_minus_b);
+        eight_sums = _mm256_add_ps(eight_sums, a_minus_b_squared);
+        x+=8;
+        y+=8;
+        if(n % ABANDON_STRIDE == 0 && n < ARR_SIZE && horizontal_sum(eight_sums) >= limit_squared){
+            return false;
+        }
+    }
+    *dist = sqrt(horizontal_sum(eight_sums));
+    return true;
 }
 
-void do_work(std::vector<match>* matches, const float* data, int thread_num, int num_files, int arr_size){
-    const float max_dist = 300;
+// Quantized summaries are ARR_SIZE uint8 values. Their differences are
+// widened to 16 bits, then squared and summed in pairs by madd, 16 values at
+// a time. The total is at most 192 * 255^2, so 32 bit sums can't overflow.
+inline bool bounded_norm(const unsigned char* x, const unsigned char* y, float limit_squared, float* dist)
+{
+    const __m128i zero = _mm_setzero_si128();
+    __m128i sums = _mm_setzero_si128();
+    for (int n = 16; n <= ARR_SIZE; n+=16){
+        const __m128i a = _mm_loadu_si128((const __m128i*) x);
+        const __m128i b = _mm_loadu_si128((const __m128i*) y);
+        const __m128i low = _mm_sub_epi16(_mm_unpacklo_epi8(a, zero), _mm_unpacklo_epi8(b, zero));
+        const __m128i high = _mm_sub_epi16(_mm_unpackhi_epi8(a, zero), _mm_unpackhi_epi8(b, zero));
+        sums = _mm_add_epi32(sums, _mm_madd_epi16(low, low));
+        sums = _mm_add_epi32(sums, _mm_madd_epi16(high, high));
+        x+=16;
+        y+=16;
+        if(n % ABANDON_STRIDE == 0 && n < ARR_SIZE && horizontal_sum(sums) >= limit_squared){
+            return false;
+        }
+    }
+    *dist = sqrt((float) horizontal_sum(sums));
+    return true;
+}
+
+// Bounds computed from rounded floats can be off by a little, so pruning keeps
+// this much relative slack. Survivors get their full distance, so the
+// result is exactly the same as comparing every pair in full.
+#define PRUNE_SLACK 1e-3f
+
+// Summaries are 8x8 grids of RGB means, row by row. Before the full distance,
+// pairs are compared on a 2x2 grid of sums of 4x4 patches and then a 4x4 grid
+// of sums of 2x2 patches, each divided by the square root of the patches in a
+// block. Those are projections onto orthonormal vectors, so their distances
+// are lower bounds on the full distance, and a pair already the cutoff apart
+// on a coarse grid is skipped.
+// The 2x2 grid has 12 values, padded to 16 for AVX.
+#define GRID 8
+#define CHANNELS 3
+#define COARSE_SIZE 16
+#define MEDIUM_SIZE 48
+
+template<typename T>
+struct cascade
+{
+    const T* data;
+    std::vector<float> coarse;
+    std::vector<float> medium;
+};
+
+// Pairs handled by one thread, by the stage that settled them.
+struct cascade_counts
+{
+    long long compared;
+    long long coarse_rejected;
+    long long medium_rejected;
+    long long full_rejected;
+    long long abandoned;
+    long long matched;
+};
+
+static cascade_counts last_counts;
+
+template<typename T>
+void build_cascade(cascade<T>* c, const T* data, int num_files){
+    c->data = data;
+    c->coarse.assign((size_t) num_files * COARSE_SIZE, 0);
+    c->medium.assign((size_t) num_files * MEDIUM_SIZE, 0);
+
+    for(int i = 0; i < num_files; ++i){
+        const T* row = data + (size_t) i * ARR_SIZE;
+        double coarse[COARSE_SIZE] = {0};
+        double medium[MEDIUM_SIZE] = {0};
+        for(int y = 0; y < GRID; ++y){
+            for(int x = 0; x < GRID; ++x){
+                for(int ch = 0; ch < CHANNELS; ++ch){
+                    float v = row[(y * GRID + x) * CHANNELS + ch];
+                    medium[((y / 2) * (GRID / 2) + x / 2) * CHANNELS + ch] += v;
+                    coarse[((y / 4) * (GRID / 4) + x / 4) * CHANNELS + ch] += v;
+                }
+            }
+        }
+        // Blocks of 4 and 16 patches.
+        for(int k = 0; k < MEDIUM_SIZE; ++k){
+            c->medium[(size_t) i * MEDIUM_SIZE + k] = medium[k] / 2;
+        }
+        for(int k = 0; k < COARSE_SIZE; ++k){
+            c->coarse[(size_t) i * COARSE_SIZE + k] = coarse[k] / 4;
+        }
+    }
+}
+
+// Returns whether rows i and j are closer than cutoff, with their distance
+// in *dist if they are.
+template<typename T>
+inline bool cascade_match(const cascade<T>* c, cascade_counts* counts, int i, int j, float cutoff, float* dist){
+    float reach = cutoff * (1 + PRUNE_SLACK);
+    float reach_squared = reach * reach;
+
+    counts->compared++;
+    if(sum_of_squares<COARSE_SIZE>(c->coarse.data() + (size_t) i * COARSE_SIZE,
+        c->coarse.data() + (size_t) j * COARSE_SIZE) >= reach_squared){
+        counts->coarse_rejected++;
+        return false;
+    }
+    if(sum_of_squares<MEDIUM_SIZE>(c->medium.data() + (size_t) i * MEDIUM_SIZE,
+        c->medium.data() + (size_t) j * MEDIUM_SIZE) >= reach_squared){
+        counts->medium_rejected++;
+        return false;
+    }
+
+    if(!bounded_norm(c->data + (size_t) i * ARR_SIZE, c->data + (size_t) j * ARR_SIZE, reach_squared, dist)){
+        counts->full_rejected++;
+        counts->abandoned++;
+        return false;
+    }
+    if(*dist < cutoff){
+        counts->matched++;
+        return true;
+    }
+    counts->full_rejected++;
+    return false;
+}
+
+inline void add_match(std::vector<match>* matches, int left, int right, float dist){
+    matches->push_back(match());
+    matches->back().left = left;
+    matches->back().right = right;
+    matches->back().distance = dist;
+}
+
+// The k nearest matches of one row found so far, as a max-heap on distance.
+// Once there are k, a row has to be closer than the k-th to get in, so that
+// distance becomes the cutoff.
+struct nearest
+{
+    int k;
+    float max_dist;
+    std::vector<std::pair<float, int> > heap;
+
+    float cutoff() const {
+        return (int) heap.size() < k ? max_dist : heap.front().first;
+    }
+
+    void add(float dist, int j){
+        heap.push_back(std::make_pair(dist, j));
+        std::push_heap(heap.begin(), heap.end());
+        if((int) heap.size() > k){
+            std::pop_heap(heap.begin(), heap.end());
+            heap.pop_back();
+        }
+    }
+
+    // Reports the pairs from the lower index, as elsewhere. A pair that is
+    // among the nearest of both rows comes out twice, and gather drops one.
+    void flush(std::vector<match>* matches, int i){
+        for(const auto& p: heap){
+            add_match(matches, std::min(i, p.second), std::max(i, p.second), p.first);
+        }
+        heap.clear();
+    }
+};
+
+template<typename T>
+void do_work(std::vector<match>* matches, cascade_counts* counts, const cascade<T>* c, int thread_num,
+    int num_files, float max_dist){
     float dist;
     for(int i = thread_num; i < num_files; i = i + NUM_THREADS){
         for(int j = i + 1; j < num_files; ++j){
-             dist = norm(data+i*ARR_SIZE, data+j*ARR_SIZE);
-             if (dist < max_dist){
-                 matches->push_back(match());
-                 matches->back().left = i;
-                 matches->back().right = j;
-                 matches->back().distance = dist;
+             if (cascade_match(c, counts, i, j, max_dist, &dist)){
+                 add_match(matches, i, j, dist);
              }
         }
     }
 }
 
-void search(const float* data, int num_files, int arr_size)
+template<typename T>
+void top_k_work(std::vector<match>* matches, cascade_counts* counts, const cascade<T>* c, int thread_num,
+    int num_files, float max_dist, int k){
+    nearest found;
+    found.k = k;
+    found.max_dist = max_dist;
+    float dist;
+    for(int i = thread_num; i < num_files; i = i + NUM_THREADS){
+        for(int j = 0; j < num_files; ++j){
+            if (j != i && cascade_match(c, counts, i, j, found.cutoff(), &dist)){
+                found.add(dist, j);
+            }
+        }
+        found.flush(matches, i);
+    }
+}
+
+// The index works on a few projected coordinates per row (the leading
+// principal components, computed by the caller). Projecting onto orthonormal
+// axes never increases a distance, so a pair whose projected distance is
+// already max_dist or more can be skipped. Projections are rounded to float,
+// so pruning keeps PRUNE_SLACK. Survivors go through the same cascade as in
+// the full scan, so the result is exactly the same.
+#define LEAF_SIZE 16
+
+struct kd_node
 {
-    std::vector<match>* results[NUM_THREADS];
+    int begin;
+    int end;
+    int dim;
+    float split;
+    int left;
+    int right;
+};
+
+struct kd_tree
+{
+    const float* coords;
+    int dims;
+    std::vector<int> items;
+    std::vector<kd_node> nodes;
+};
+
+int build_node(kd_tree* tree, int begin, int end){
+    kd_node node;
+    node.begin = begin;
+    node.end = end;
+    node.dim = 0;
+    node.split = 0;
+    node.left = -1;
+    node.right = -1;
+
+    int node_num = tree->nodes.size();
+    tree->nodes.push_back(node);
+
+    if(end - begin <= LEAF_SIZE){
+        return node_num;
+    }
+
+    // Split the widest coordinate at its median.
+    const float* coords = tree->coords;
+    int dims = tree->dims;
+    int best_dim = 0;
+    float best_spread = -1;
+    for(int d = 0; d < dims; ++d){
+        float low = coords[(size_t) tree->items[begin] * dims + d];
+        float high = low;
+        for(int k = begin + 1; k < end; ++k){
+            float c = coords[(size_t) tree->items[k] * dims + d];
+            low = std::min(low, c);
+            high = std::max(high, c);
+        }
+        if(high - low > best_spread){
+            best_spread = high - low;
+            best_dim = d;
+        }
+    }
+
+    int mid = (begin + end) / 2;
+    std::nth_element(tree->items.begin() + begin, tree->items.begin() + mid, tree->items.begin() + end,
+        [coords, dims, best_dim](int a, int b){
+            return coords[(size_t) a * dims + best_dim] < coords[(size_t) b * dims + best_dim];
+        });
+
+    // Read the split before the children reorder their items.
+    float split = coords[(size_t) tree->items[mid] * dims + best_dim];
+    int left = build_node(tree, begin, mid);
+    int right = build_node(tree, mid, end);
+
+    tree->nodes[node_num].dim = best_dim;
+    tree->nodes[node_num].split = split;
+    tree->nodes[node_num].left = left;
+    tree->nodes[node_num].right = right;
+    return node_num;
+}
+
+template<typename T>
+void rows_work(std::vector<match>* matches, cascade_counts* counts, const cascade<T>* c, const int* rows,
+    const char* is_row, int num_rows, int thread_num, int num_files, float max_dist){
+    float dist;
+    for(int k = thread_num; k < num_rows; k = k + NUM_THREADS){
+        int i = rows[k];
+        for(int j = 0; j < num_files; ++j){
+            // Pairs of two listed rows are reported once, from the lower index.
+            if(j == i || (is_row[j] && j < i)){
+                continue;
+            }
+            int left = std::min(i, j);
+            int right = std::max(i, j);
+            if (cascade_match(c, counts, left, right, max_dist, &dist)){
+                add_match(matches, left, right, dist);
+            }
+        }
+    }
+}
+
+template<typename T>
+struct kd_query
+{
+    const kd_tree* tree;
+    const cascade<T>* c;
+    cascade_counts* counts;
+    std::vector<match>* matches;
+    int row;
+    const float* q;
+    // Distance from q to the current cell along each split coordinate.
+    std::vector<float> offsets;
+    float max_dist;
+    float reach_squared;
+    // With k > 0, only the k nearest of each row are kept.
+    int k;
+    nearest found;
+};
+
+template<typename T>
+void search_node(kd_query<T>* query, int node_num, float cell_dist_squared){
+    const kd_tree* tree = query->tree;
+    const kd_node& node = tree->nodes[node_num];
+    const float* q = query->q;
+
+    if(node.left >= 0){
+        // Search the side q is on with the same bound, then the far side with
+        // the bound moved to the split plane.
+        float diff = q[node.dim] - node.split;
+        int near_node = diff <= 0 ? node.left : node.right;
+        int far_node = diff <= 0 ? node.right : node.left;
+
+        search_node(query, near_node, cell_dist_squared);
+
+        float old_offset = query->offsets[node.dim];
+        float far_dist_squared = cell_dist_squared - old_offset * old_offset + diff * diff;
+        if(far_dist_squared < query->reach_squared){
+            query->offsets[node.dim] = diff;
+            search_node(query, far_node, far_dist_squared);
+            query->offsets[node.dim] = old_offset;
+        }
+        return;
+    }
+
+    const float* coords = tree->coords;
+    int dims = tree->dims;
+    int i = query->row;
+    for(int k = node.begin; k < node.end; ++k){
+        int j = tree->items[k];
+        // Matches are reported once, from the lower index, as in do_work,
+        // unless each row needs its own nearest.
+        if(query->k == 0 ? j <= i : j == i){
+            continue;
+        }
+
+        const float* c = coords + (size_t) j * dims;
+        float projected = 0;
+        for(int d = 0; d < dims; ++d){
+            projected += (q[d] - c[d]) * (q[d] - c[d]);
+        }
+        if(projected >= query->reach_squared){
+            continue;
+        }
+
+        float dist;
+        if(query->k == 0){
+            if (cascade_match(query->c, query->counts, i, j, query->max_dist, &dist)){
+                add_match(query->matches, i, j, dist);
+            }
+        }
+        else if (cascade_match(query->c, query->counts, i, j, query->found.cutoff(), &dist)){
+            query->found.add(dist, j);
+            float reach = query->found.cutoff() * (1 + PRUNE_SLACK);
+            query->reach_squared = reach * reach;
+        }
+    }
+}
+
+template<typename T>
+void query_work(std::vector<match>* matches, cascade_counts* counts, const kd_tree* tree, const cascade<T>* c,
+    int thread_num, int num_files, float max_dist, int k){
+    float reach = max_dist * (1 + PRUNE_SLACK);
+
+    kd_query<T> query;
+    query.tree = tree;
+    query.c = c;
+    query.counts = counts;
+    query.matches = matches;
+    query.max_dist = max_dist;
+    query.k = k;
+    query.found.k = k;
+    query.found.max_dist = max_dist;
+
+    for(int i = thread_num; i < num_files; i = i + NUM_THREADS){
+        query.row = i;
+        query.q = tree->coords + (size_t) i * tree->dims;
+        query.offsets.assign(tree->dims, 0);
+        query.reach_squared = reach * reach;
+        search_node(&query, 0, 0);
+        query.found.flush(matches, i);
+    }
+}
+
+bool same_pair(const match& a, const match& b)
+{
+    return a.left == b.left && a.right == b.right;
+}
+
+bool pair_order(const match& a, const match& b)
+{
+    return a.left < b.left || (a.left == b.left && a.right < b.right);
+}
+
+// Collects the matches of all threads into one malloc'd array. With unique,
+// pairs found from both of their rows are only kept once.
+long gather(std::vector<match>** thread_results, const cascade_counts* thread_counts, bool unique,
+    match** results)
+{
+    size_t total = 0;
+    last_counts = cascade_counts();
+    for(int t = 0; t < NUM_THREADS; ++t){
+        total += thread_results[t]->size();
+        last_counts.compared += thread_counts[t].compared;
+        last_counts.coarse_rejected += thread_counts[t].coarse_rejected;
+        last_counts.medium_rejected += thread_counts[t].medium_rejected;
+        last_counts.full_rejected += thread_counts[t].full_rejected;
+        last_counts.abandoned += thread_counts[t].abandoned;
+        last_counts.matched += thread_counts[t].matched;
+    }
+
+    match* output = (match*) std::malloc(std::max(total, (size_t) 1) * sizeof(match));
+    size_t pos = 0;
+    for(int t = 0; t < NUM_THREADS; ++t){
+        std::copy(thread_results[t]->begin(), thread_results[t]->end(), output + pos);
+        pos += thread_results[t]->size();
+        delete(thread_results[t]);
+    }
+
+    if(unique){
+        std::sort(output, output + total, pair_order);
+        total = std::unique(output, output + total, same_pair) - output;
+    }
+
+    *results = output;
+    return total;
+}
+
+template<typename T>
+long search(const T* data, int num_files, float max_dist, int k, match** results)
+{
+    cascade<T> c;
+    build_cascade(&c, data, num_files);
+
+    std::vector<match>* thread_results[NUM_THREADS];
+    cascade_counts thread_counts[NUM_THREADS] = {};
     std::thread pool[NUM_THREADS];
 
     for(int t = 0; t < NUM_THREADS; ++t){
-        results[t] = new std::vector<match>();
-        //~ pool[t] = std::thread(do_work, t, data, num_files, arr_size);
-        pool[t] = std::thread(do_work, results[t], data, t, num_files, arr_size);
+        thread_results[t] = new std::vector<match>();
+        if(k > 0){
+            pool[t] = std::thread(top_k_work<T>, thread_results[t], &thread_counts[t], &c, t, num_files,
+                max_dist, k);
+        }
+        else{
+            pool[t] = std::thread(do_work<T>, thread_results[t], &thread_counts[t], &c, t, num_files,
+                max_dist);
+        }
     }
 
-    std::cout <<"Waiting for threads" << std::endl;
     for(auto& t: pool){
         t.join();
     }
 
-    std::ofstream output("matches.dat");
+    return gather(thread_results, thread_counts, k > 0, results);
+}
+
+template<typename T>
+long search_rows(const T* data, int num_files, const int* rows, int num_rows,
+    float max_dist, match** results)
+{
+    std::vector<char> is_row(num_files, 0);
+    for(int k = 0; k < num_rows; ++k){
+        is_row[rows[k]] = 1;
+    }
+
+    cascade<T> c;
+    build_cascade(&c, data, num_files);
+
+    std::vector<match>* thread_results[NUM_THREADS];
+    cascade_counts thread_counts[NUM_THREADS] = {};
+    std::thread pool[NUM_THREADS];
 
     for(int t = 0; t < NUM_THREADS; ++t){
-        std::cout << "number of results in thread " << t << " = " << results[t]->size() << std::endl;
-        for(auto const& m: *results[t]){
-            output << m.distance << "," << m.left << "," << m.right << std::endl;
-        }
-        delete(results[t]);
+        thread_results[t] = new std::vector<match>();
+        pool[t] = std::thread(rows_work<T>, thread_results[t], &thread_counts[t], &c, rows,
+            is_row.data(), num_rows, t, num_files, max_dist);
     }
-    output.close();
+
+    for(auto& t: pool){
+        t.join();
+    }
+
+    return gather(thread_results, thread_counts, false, results);
 }
 
-int main()
+template<typename T>
+long search_index(const T* data, const float* coords, int coord_dims,
+    int num_files, float max_dist, int k, match** results)
 {
-    const char* filename = "summaries.dat";
+    kd_tree tree;
+    tree.coords = coords;
+    tree.dims = coord_dims;
+    for(int i = 0; i < num_files; ++i){
+        tree.items.push_back(i);
+    }
+    build_node(&tree, 0, num_files);
 
-    int arr_size, num_files;
-    std::ifstream infile(filename);
-    infile >> num_files;
-    infile >> arr_size;
+    cascade<T> c;
+    build_cascade(&c, data, num_files);
 
-    if(arr_size != ARR_SIZE){
-        std::cout <<"Invalid file" << std::endl;
-        std::exit(EXIT_FAILURE);
-    }
+    std::vector<match>* thread_results[NUM_THREADS];
+    cascade_counts thread_counts[NUM_THREADS] = {};
+    std::thread pool[NUM_THREADS];
 
-    float* data = new float[num_files * arr_size * sizeof(float)];
-    char delim;
+    for(int t = 0; t < NUM_THREADS; ++t){
+        thread_results[t] = new std::vector<match>();
+        pool[t] = std::thread(query_work<T>, thread_results[t], &thread_counts[t], &tree, &c,
+            t, num_files, max_dist, k);
+    }
 
-    for(int f = 0; f < num_files; ++f){
-        for(int i = 0; i < arr_size; ++i){
-            infile >> val(f, i);
-            infile >> delim;
-        }
+    for(auto& t: pool){
+        t.join();
     }
-    infile.close();
 
-    search(data, num_files, arr_size);
-    delete[] data;
+    return gather(thread_results, thread_counts, k > 0, results);
+}
+
+extern "C" {
+
+// Changes whenever the functions below do, so callers can tell an outdated
+// build apart.
+int fast_match_version()
+{
+    return API_VERSION;
+}
+
+// Finds all pairs of rows in data (num_files x ARR_SIZE floats, row major)
+// closer than max_dist. With k > 0, only pairs where one row is among the k
+// nearest of the other are kept. The matches are returned in *results, which
+// must be released with fast_match_free. Returns the number of matches.
+long fast_match_search(const float* data, int num_files, float max_dist, int k, match** results)
+{
+    return search(data, num_files, max_dist, k, results);
+}
+
+// Like fast_match_search, but only finds pairs involving at least one of the
+// num_rows row numbers in rows. Distances are computed exactly as there.
+long fast_match_search_rows(const float* data, int num_files, const int* rows, int num_rows,
+    float max_dist, match** results)
+{
+    return search_rows(data, num_files, rows, num_rows, max_dist, results);
+}
+
+// Same results as fast_match_search, but only compares rows whose projected
+// coordinates (num_files x coord_dims floats) are close, using a k-d tree.
+long fast_match_search_index(const float* data, const float* coords, int coord_dims,
+    int num_files, float max_dist, int k, match** results)
+{
+    return search_index(data, coords, coord_dims, num_files, max_dist, k, results);
+}
+
+// The same three searches on quantized summaries, ARR_SIZE uint8 per row.
+long fast_match_search_u8(const unsigned char* data, int num_files, float max_dist, int k, match** results)
+{
+    return search(data, num_files, max_dist, k, results);
+}
+
+long fast_match_search_rows_u8(const unsigned char* data, int num_files, const int* rows, int num_rows,
+    float max_dist, match** results)
+{
+    return search_rows(data, num_files, rows, num_rows, max_dist, results);
+}
+
+long fast_match_search_index_u8(const unsigned char* data, const float* coords, int coord_dims,
+    int num_files, float max_dist, int k, match** results)
+{
+    return search_index(data, coords, coord_dims, num_files, max_dist, k, results);
+}
+
+void fast_match_free(match* results)
+{
+    std::free(results);
+}
+
+// How many pairs the last search compared, and how many of those were
+// rejected on the 2x2 grid, the 4x4 grid and the full summaries (of which
+// some part way through), and matched.
+void fast_match_stats(long long* counts)
+{
+    counts[0] = last_counts.compared;
+    counts[1] = last_counts.coarse_rejected;
+    counts[2] = last_counts.medium_rejected;
+    counts[3] = last_counts.full_rejected;
+    counts[4] = last_counts.abandoned;
+    counts[5] = last_counts.matched;
+}
+
+int fast_match_summary_size()
+{
+    return ARR_SIZE;
+}
 
-    std::exit(0);
 }
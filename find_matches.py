@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 import sys
+import argparse
+import contextlib
+import shlex
 from os import listdir
 import os
 from os.path import isfile, join
@@ -9,14 +12,17 @@ import time
 from math import ceil
 import json
 import numpy as np
-from joblib import Parallel, delayed
 import multiprocessing
+import queue
+import threading
 import dbmanager
 from stat import *
 from similarity import *
-from display_results import display
-
-cleanup = True
+from matching import match_pairs, summary_matrix, library_path, max_dist
+from duplicates import find_exact_duplicates, unique_files, exact_scores, full_hash
+from summarizer import SummaryPool, get_summary, default_num_workers
+import thumbnails
+from results import write_results, read_results, result_formats
 
 def timing(f):
     def wrap(*args):
@@ -27,152 +33,398 @@ def timing(f):
         return ret
     return wrap
 
-@timing
-def recursive_get_image_files(folder):
-    possible_image_files = []
-
-    all_file_len = 0
-    for root, dirs, files in os.walk(folder):
-        for f in files:
-            all_file_len = all_file_len + 1
-            fullpath = join(root, f)
-            if os.path.isfile(fullpath):
-                possible_image_files.append(fullpath)
-
-    print("all_file_len",all_file_len)
-    print("normal file len",len(possible_image_files))
-    return possible_image_files
-
-def get_summary(f):
+# Only files with an extension Pillow can open are considered, so other
+# files are never stat'ed or opened.
+image_extensions = set(ext for ext, fmt in Image.registered_extensions().items()
+    if fmt in Image.OPEN)
+
+# Paths are handed from the directory walk to the cache lookup in batches of
+# at most this many, or whatever was found in walk_flush_seconds.
+walk_batch_size = 1000
+walk_flush_seconds = 0.5
+
+# Bounds on work held in memory between the stages of the scan. Results
+# waiting to be written are limited by write_queue_size.
+walk_queue_size = 16
+write_queue_size = 4096
+max_pending_files = 256
+
+# Files are sent to the summary workers in chunks of this many.
+summary_chunk_size = 8
+
+# Summaries are written to the cache in transactions of this many files, or
+# at least every write_flush_seconds.
+write_batch_size = 500
+write_flush_seconds = 2.0
+
+# Matching is incremental unless more than this fraction of files is new or
+# changed since the last match.
+incremental_max_fraction = 0.5
+
+def is_image_file(entry):
+    ext = os.path.splitext(entry.name)[1].lower()
+    if not ext in image_extensions:
+        return False
     try:
-        return patch_stats(load_image(f), f)
+        # Uses d_type from the directory listing, only symlinks need a stat.
+        return entry.is_file()
     except OSError as e:
-        #~ print("OSError accessing ",f)
-        return None
-    except TimeoutError as e:
-        print("Timeout accessing ",f)
-        return None
+        return False
 
-def cleanup_file(filename):
-    if cleanup:
+def iter_image_files(folder):
+    pending = [folder]
+    while len(pending) > 0:
+        current = pending.pop()
         try:
-            os.remove(filename)
-        except FileNotFoundError as e:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                            continue
+                    except OSError as e:
+                        continue
+                    if is_image_file(entry):
+                        yield entry.path
+        except OSError as e:
+            print("Could not read folder", current)
+
+def batch_in_background(paths, batch_queue):
+    batch = []
+    last_put = time.monotonic()
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= walk_batch_size or time.monotonic() - last_put > walk_flush_seconds:
+            batch_queue.put(batch)
+            batch = []
+            last_put = time.monotonic()
+    batch_queue.put(batch)
+    batch_queue.put(None)
+
+def background_batches(paths):
+    # Runs the paths generator (usually a directory walk) in a thread, so
+    # the batches it has produced can be processed while it continues.
+    batch_queue = queue.Queue(maxsize=walk_queue_size)
+    walker = threading.Thread(target=batch_in_background, args=(paths, batch_queue))
+    walker.daemon = True
+    walker.start()
+
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        yield batch
+
+def write_in_background(write_queue):
+    new_files = []
+    summaries = {}
+    fingerprints = {}
+    hashes = {}
+    bad_files = set([])
+
+    last_flush = time.monotonic()
+    running = True
+    while running:
+        try:
+            item = write_queue.get(timeout=write_flush_seconds)
+            if item is None:
+                running = False
+            elif len(item) == 2:
+                # The full hash of a file whose summary was sent earlier.
+                filename, digest = item
+                hashes[filename] = digest
+            else:
+                filename, summary, fp, digest = item
+                if digest is not None:
+                    hashes[filename] = digest
+                if summary is None:
+                    bad_files.add(filename)
+                else:
+                    new_files.append(filename)
+                    summaries[filename] = summary
+                    if fp is not None:
+                        fingerprints[filename] = fp
+        except queue.Empty as e:
             pass
 
-@timing
-def get_cached_summaries(files):
-    return dbmanager.load(files)
-
-@timing
-def write_cached_summaries(new_files, summaries, bad_files):
-    dbmanager.update(new_files, summaries, bad_files)
+        pending = len(new_files) + len(bad_files)
+        overdue = time.monotonic() - last_flush >= write_flush_seconds
+        due = pending >= write_batch_size or overdue or not running
+        if (pending > 0 or len(hashes) > 0) and due:
+            dbmanager.update(new_files, summaries, bad_files, fingerprints, hashes)
+            new_files = []
+            summaries = {}
+            fingerprints = {}
+            hashes = {}
+            bad_files = set([])
+            last_flush = time.monotonic()
 
 @timing
-def parallel_get_summaries(new_files, num_threads=16):
-    new_summary_arr = []
-    if len(new_files) > 0:
-        try:
-            print("Summarizing new files")
-            new_summary_arr = Parallel(n_jobs=num_threads)(delayed(get_summary)(f) for f in new_files)
-        except KeyboardInterrupt as e:
-            # Allow cancelling easily if something hangs.
-            print("Got a keyboard interrupt, quitting")
-            raise KeyboardInterrupt("QUIT")
-    return new_summary_arr
-
-def get_summaries(files):
-    print("Reading summary cache")
-    summaries, bad_files = get_cached_summaries(files)
-
-    numfiles = len(files)
+def get_summaries(paths, num_workers=None):
+    # Looks up, summarizes and caches files while paths (a list or a
+    # generator) is still producing them. Returns all paths in the order they
+    # were produced, and the summaries of the good ones.
+    #
+    # Results are committed to the cache as they arrive, so if the scan is
+    # interrupted or crashes, the next run only summarizes what is left.
+    files = []
+    summaries = {}
+    totals = {"found": 0, "reused": 0, "recomputed": 0, "new": 0, "bad": 0}
+
+    write_queue = queue.Queue(maxsize=write_queue_size)
+    writer = threading.Thread(target=write_in_background, args=(write_queue,))
+    writer.start()
+
+    chunk = []
+    # Files with the same contents as one already being summarized wait for
+    # its result instead of being decoded again. Files are grouped by
+    # fingerprint, which only covers part of the file, and a full hash
+    # confirms the copy.
+    leaders = {}
+    # Fingerprints the cache lookup computed and full hashes of files read
+    # in full, passed on to the cache write so no file is read twice.
+    fingerprints = {}
+    hashes = {}
+    followers = {}
+
+    def file_hash(f):
+        if not f in hashes:
+            hashes[f] = full_hash(f)
+            if f in summaries and hashes[f] is not None:
+                # Already sent to the writer without it.
+                write_queue.put((f, hashes[f]))
+        return hashes[f]
+
+    def same_content(f, fp):
+        # The file of leaders[fp] whose whole contents match f, or None.
+        if not fp in leaders:
+            return None
+        h = file_hash(f)
+        if h is None:
+            return None
+        for leader in leaders[fp]:
+            if file_hash(leader) == h:
+                return leader
+        return None
 
-    new_files = []
-    for f in files:
-        if not f in summaries and not f in bad_files:
-            new_files.append(f)
+    def finish(filename, summary):
+        copies = followers.pop(filename, [])
+        if summary is None:
+            totals["bad"] = totals["bad"] + 1
+            # The fingerprint only covers part of the file, so copies of a
+            # bad file get a chance of their own.
+            pool.submit(copies)
+            copies = []
 
-    new_summary_arr = parallel_get_summaries(new_files)
+        for f in [filename] + copies:
+            if summary is not None:
+                summaries[f] = summary
+            write_queue.put((f, summary, fingerprints.pop(f, None), hashes.get(f)))
 
-    summarized_files = []
-    for i in range(0, len(new_summary_arr)):
-        summary = new_summary_arr[i]
-        filename = new_files[i]
-        if summary is None:
-            bad_files.add(filename)
-        else:
-            summarized_files.append(filename)
-            summaries[filename] = summary
+    def collect(timeout=None):
+        for filename, summary in pool.collect(timeout):
+            finish(filename, summary)
 
-    print("Updating summary cache")
-    write_cached_summaries(summarized_files, summaries, bad_files)
-    return summaries
+    try:
+        with SummaryPool(num_workers) as pool:
+            try:
+                for batch in background_batches(paths):
+                    files.extend(batch)
+                    cached, bad_files, counts, batch_fingerprints, batch_hashes = \
+                        dbmanager.load(batch, report=False)
+                    fingerprints.update(batch_fingerprints)
+                    hashes.update(batch_hashes)
+                    summaries.update(cached)
+                    for key in totals:
+                        totals[key] = totals[key] + counts[key]
+
+                    for f in batch:
+                        if f in cached or f in bad_files:
+                            continue
+
+                        fp = fingerprints.get(f)
+                        leader = same_content(f, fp)
+                        if leader is not None:
+                            if leader in summaries:
+                                summaries[f] = summaries[leader]
+                                write_queue.put((f, summaries[leader],
+                                    fingerprints.pop(f, None), hashes.get(f)))
+                            elif leader in followers:
+                                followers[leader].append(f)
+                            else:
+                                chunk.append(f)
+                            continue
+                        if fp is not None:
+                            leaders.setdefault(fp, []).append(f)
+                            followers[f] = []
+
+                        chunk.append(f)
+                        if len(chunk) >= summary_chunk_size:
+                            while pool.pending() >= max_pending_files:
+                                collect()
+                            pool.submit(chunk)
+                            chunk = []
+
+                    collect(0)
+
+                pool.submit(chunk)
+                chunk = []
+                while pool.pending() > 0:
+                    collect()
+            except KeyboardInterrupt as e:
+                # Allow cancelling easily if something hangs. Summaries that
+                # were already collected are still written to the cache below.
+                print("Got a keyboard interrupt, quitting")
+                raise KeyboardInterrupt("QUIT")
+    finally:
+        write_queue.put(None)
+        writer.join()
+
+    print("There are %d image files" % (len(files)))
+    print("Found %d, reused %d moved or copied files, %d changed files, %d new files, %d bad" % (
+        totals["found"], totals["reused"], totals["recomputed"], totals["new"], totals["bad"]))
+    return files, summaries
 
 def good_files(files, summaries):
     return [f for f in files if f in summaries]
 
+def stored_scores(files, matrix, radius):
+    # Matches all files, reusing the stored pairs of files that haven't
+    # changed since the last match with the same radius.
+    digests = [dbmanager.summary_digest(row) for row in matrix]
+
+    # Only files that are new or changed since the stored match need to be
+    # compared, against every file. Past this fraction of all files a full
+    # match is about as fast.
+    stored_radius, stored_digests, stored_pairs = dbmanager.load_matches()
+    rows = None
+    if stored_radius == radius:
+        rows = [i for i, f in enumerate(files) if stored_digests.get(f) != digests[i]]
+        if len(rows) > len(files) * incremental_max_fraction:
+            rows = None
+
+    if rows is None:
+        matches = match_pairs(matrix, radius, report=True)
+        scores = [[m[2], files[m[0]], files[m[1]]] for m in matches.tolist()]
+        dbmanager.save_matches(radius, dict(zip(files, digests)), [], scores, True)
+    else:
+        print("Matching %d new or changed files against %d files" % (len(rows), len(files)))
+        matches = match_pairs(matrix, radius, rows=rows, report=True)
+        new_scores = [[m[2], files[m[0]], files[m[1]]] for m in matches.tolist()]
+
+        changed = set(files[i] for i in rows)
+        unchanged = set(files) - changed
+        scores = [[p[2], p[0], p[1]] for p in stored_pairs
+            if p[0] in unchanged and p[1] in unchanged]
+
+        dropped = [f for f in stored_digests if not f in unchanged]
+        dbmanager.save_matches(radius, dict((files[i], digests[i]) for i in rows),
+            dropped, new_scores, False)
+        scores = scores + new_scores
+
+    return scores
+
 @timing
-def get_scores(files, summaries):
-    # clean up files if they exist
-
-    # Transform the summaries dict into an array for C++ ease
-    with open("summaries.dat", "w") as output:
-        # Write number of entries
-        output.write(str(len(files)) + "\n")
-
-        # Write length of each summary
-        summary_len = get_summary_size()
-        output.write(str(summary_len) + "\n")
-        for f in files:
-            # Each summary is an 8*8*3 array of floats
-            summary = summaries[f].tolist()
-            summary_strings = [str(s) for s in summary]
-            summary_s = ",".join(summary_strings)
-            output.write(summary_s + "\n")
-
-    if os.system("./fast_match") != 0:
-        print("Failed to run fast_match")
-        sys.exit(1)
-
-    cleanup_file("summaries.dat")
-
-    scores = []
-    with open("matches.dat", "r") as input:
-        for line in input:
-            score_set = line.split(",")
-            distance = float(score_set[0])
-            left_num = int(score_set[1])
-            right_num = int(score_set[2])
-            scores.append([distance, files[left_num], files[right_num]])
-
-    cleanup_file("matches.dat")
+def get_scores(files, summaries, radius=max_dist, k=None):
+    # With k, each image is only paired with its k nearest within radius.
+    matrix = summary_matrix(files, summaries)
+    if k is None:
+        scores = stored_scores(files, matrix, radius)
+    else:
+        # Those depend on every other image, so they can't be updated
+        # incrementally and aren't stored.
+        matches = match_pairs(matrix, radius, k=k, report=True)
+        scores = [[m[2], files[m[0]], files[m[1]]] for m in matches.tolist()]
 
     print("\n%d pairs of images are similar and will be displayed" % (len(scores)))
     scores.sort(key=lambda x: x[0])
     return scores
 
-if __name__ == "__main__":
-    if(len(sys.argv) < 2):
-        print("Usage: Pass the path to a folder as the first argument")
-        sys.exit(1)
-
-    if not os.path.exists("fast_match"):
-        ret = os.system("make")
+@timing
+def fill_thumbnails(scores):
+    # Renders the review canvases of matched files now, in the order they
+    # will be shown, so the review doesn't have to decode the originals.
+    files = []
+    seen = set()
+    for score in scores:
+        for f in score[1:3]:
+            if not f in seen:
+                seen.add(f)
+                files.append(f)
+
+    # The image cache sets up logging and shared memory when imported, which
+    # only the review needs.
+    from image_cache import canvas_size
+    rendered = thumbnails.fill(files, canvas_size, default_num_workers())
+    print("Prepared thumbnails of %d of %d matched files" % (rendered, len(files)))
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % (text))
+    return value
+
+def search(folder, radius=max_dist, k=None):
+    if not os.path.exists(library_path):
+        # The Makefile is next to the library, not in the current directory.
+        ret = os.system("make -C %s 1>&2" % (shlex.quote(os.path.dirname(library_path))))
         if ret != 0:
-            print("Could not compile fast_match, check dependencies")
-            sys.exit(1)
+            print("Could not compile fast_match, matching with numpy instead")
 
-    folder = sys.argv[1]
     print("Searching " + folder)
 
-    files = recursive_get_image_files(folder)
-    numfiles = len(files)
-    print("There are %d files to process" % (numfiles))
-
-    summaries = get_summaries(files)
+    files, summaries = get_summaries(iter_image_files(folder))
     files = good_files(files, summaries)
-    scores = get_scores(files, summaries)
-    display(scores)
-
 
+    # Identical copies are reported directly, and only one of each is
+    # compared with the other images.
+    groups = find_exact_duplicates(files)
+    files = unique_files(files, groups)
+    return exact_scores(groups) + get_scores(files, summaries, radius, k)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find similar images in a folder.")
+    parser.add_argument("folder", nargs="?")
+    parser.add_argument("--radius", type=float, default=max_dist,
+        help="Largest summary distance reported as a match (default %(default)s)")
+    parser.add_argument("--top-k", type=positive_int, default=None,
+        help="Only pair each image with its K nearest matches, which bounds "
+        "memory and output on collections of very similar images")
+    parser.add_argument("--thumbnails", action="store_true",
+        help="Render the review canvases of matched files before the review "
+        "starts, instead of while paging through it")
+    parser.add_argument("--output", metavar="FILE",
+        help="Save the matches to FILE (- for stdout) instead of opening the "
+        "review window")
+    parser.add_argument("--format", choices=result_formats, default=None,
+        help="Format of --output and --review, by default csv for .csv files "
+        "and JSON Lines otherwise")
+    parser.add_argument("--review", metavar="FILE",
+        help="Review matches saved earlier with --output instead of searching")
+    args = parser.parse_args()
+
+    if args.review is None and args.folder is None:
+        parser.error("a folder or --review is required")
+
+    # Progress goes to stderr when the matches are written to stdout.
+    progress = contextlib.nullcontext()
+    if args.output == "-":
+        progress = contextlib.redirect_stdout(sys.stderr)
+
+    with progress:
+        if args.review is not None:
+            scores = read_results(args.review, args.format)
+        else:
+            scores = search(args.folder, args.radius, args.top_k)
+
+        if args.thumbnails:
+            fill_thumbnails(scores)
+
+    if args.output is not None:
+        count = write_results(scores, args.output, args.format)
+        print("Saved %d pairs to %s" % (count, args.output), file=sys.stderr)
+    else:
+        # GTK is only loaded for the review, so searches can run where it
+        # isn't installed.
+        from display_results import display
+        display(scores)
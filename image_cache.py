@@ -1,15 +1,17 @@
 import multiprocessing as mp
+from multiprocessing.connection import wait
+from multiprocessing import shared_memory
+from collections import deque, OrderedDict
 import time
 from PIL import Image
-from math import ceil
 from io import BytesIO
-from os.path import join, getsize
+from os.path import join
 import os
 import time
-import ctypes
 from pprint import pprint
 import traceback
 import sys
+import thumbnails
 
 # Since processes do not report exceptions to the main process,
 # it is necessary to log ALL exceptions.
@@ -20,94 +22,142 @@ handler = logging.FileHandler('error.log')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# Canvases are always this size, RGB.
+canvas_size = (600, 600)
+canvas_bytes = canvas_size[0] * canvas_size[1] * 3
+
+# Loaders keep scaled images on disk between sessions, see thumbnails.py.
+use_thumbnails = True
+
+# Default memory for cached canvases, about 40 of them.
+default_cache_bytes = 40 * canvas_bytes
+
+# The files of this many recent fetches are never evicted, so their slots
+# aren't overwritten while the GUI is still drawing them.
+pinned_fetches = 4
+
+class CanvasSlabs:
+    """
+    Fixed size slots for canvases in one block of shared memory. Loaders
+    render into a slot and only the slot number is sent between processes,
+    so canvases are never pickled or copied on their way to the GUI. The
+    cache processes are forked and share the mapping.
+    """
+
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * canvas_bytes)
+
+    def write(self, slot, canvas):
+        self.shm.buf[slot * canvas_bytes:(slot + 1) * canvas_bytes] = canvas.tobytes()
+
+    def canvas(self, slot):
+        # A view of the slot, valid until the slot is reused.
+        view = self.shm.buf[slot * canvas_bytes:(slot + 1) * canvas_bytes]
+        return Image.frombuffer("RGB", canvas_size, view, "raw", "RGB", 0, 1)
+
+    def unlink(self):
+        try:
+            self.shm.close()
+        except BufferError as e:
+            # Canvases still point into the block; it goes when they do.
+            pass
+        self.shm.unlink()
+
 class AsyncCanvasLoader:
-    def __init__(self):
+    def __init__(self, slabs, thumbnail_queue=None):
+        self.slabs = slabs
+        # New thumbnails go to the writer reading this queue, or are saved by
+        # the loader itself after sending the result if there is none.
+        self.thumbnail_queue = thumbnail_queue
+        # The slot the current job renders into.
+        self.slot = None
         (self.reader, worker_writer) = mp.Pipe(duplex=False)
         (worker_reader, self.writer) = mp.Pipe(duplex=False)
-        self.idle_flag = mp.Value(ctypes.c_bool, True)
-        self.result_flag = mp.Value(ctypes.c_bool, False)
+        # The file being loaded, or None when idle.
+        self.job = None
 
         self.loader = mp.Process(target=self.canvas_loader, args=(
-            worker_reader, worker_writer, self.idle_flag, self.result_flag
+            worker_reader, worker_writer
         ))
 
         self.loader.start()
 
     # Public Interface
-    def set_job(self, filename):
-        self.idle_flag.value = False
-        self.writer.send({"job":filename})
+    def set_job(self, filename, slot):
+        self.job = filename
+        self.slot = slot
+        self.writer.send({"job":filename, "slot":slot})
 
     def is_idle(self):
-        return self.idle_flag.value
+        return self.job is None
 
     def has_result(self):
-        return self.result_flag.value
+        return self.job is not None and self.reader.poll()
 
     def get_result(self):
-        self.result_flag.value = False
-        self.idle_flag.value = True
-        self.writer.send({"fetch":0})
-        return self.reader.recv()
+        # Blocks until the job is done.
+        res = self.reader.recv()
+        self.job = None
+        return res
 
     def quit(self):
         self.writer.send({"quit":0})
         self.loader.join()
 
     # Async and Private
-    def canvas_loader(self, reader, writer, idle_flag, result_flag):
+    def canvas_loader(self, reader, writer):
+        # Sleeps in recv until there is a job, and sends each result as soon
+        # as it is ready. The canvas goes into the job's slot and the result
+        # only says which slot that was. New thumbnails are handed to the
+        # thumbnail writer, so the next job doesn't wait on the encoding.
         try:
-            self.is_running = True
-            filename = None
-            result = None
-
-            while self.is_running:
-                if reader.poll():
-                    msg = reader.recv()
-                    if "job" in msg:
-                        filename = msg["job"]
-                    elif "quit" in msg:
-                        self.is_running = False
-                    elif "fetch" in msg:
-                        writer.send(result)
-                    else:
-                        raise Exception("Unknown command:", msg)
-
-                if filename is not None:
-                    result = self.load_image_data(filename)
-                    result_flag.value = True
-                    filename = None
+            while True:
+                msg = reader.recv()
+                if "job" in msg:
+                    new_thumbnails = []
+                    res = self.safe_load_image_data(msg["job"], new_thumbnails)
+                    if res is not None:
+                        self.slabs.write(msg["slot"], res.pop("canvas"))
+                        res["slot"] = msg["slot"]
+                    writer.send(res)
+                    for args in new_thumbnails:
+                        if self.thumbnail_queue is not None:
+                            self.thumbnail_queue.put(args)
+                        else:
+                            thumbnails.store(*args)
+                elif "quit" in msg:
+                    break
+                else:
+                    raise Exception("Unknown command:", msg)
 
         except Exception as e:
             logger.error("".join(traceback.format_exception(*sys.exc_info())))
 
-    def load_image_data(self, filename):
+    def safe_load_image_data(self, filename, new_thumbnails=None):
+        # One unreadable file shouldn't stop the loader, the cacher is waiting
+        # for an answer.
         try:
-            img_orig = Image.open(filename)
-            filesize = getsize(filename)
+            return self.load_image_data(filename, new_thumbnails)
+        except Exception as e:
+            logger.error("".join(traceback.format_exception(*sys.exc_info())))
+            return None
+
+    def load_image_data(self, filename, new_thumbnails=None):
+        try:
+            img, width, height, filesize = thumbnails.render(
+                filename, canvas_size, use_thumbnails, new_thumbnails)
         except FileNotFoundError as e:
-            print("Expected file %s is missing" % (path))
+            print("Expected file %s is missing" % (filename))
             print(e)
             return None
 
-        size = (600, 600)
-        x_size = size[0]
-        y_size = size[1]
-        x_resize_ratio = img_orig.size[0] / x_size
-        y_resize_ratio = img_orig.size[1] / y_size
-
-        if(x_resize_ratio > y_resize_ratio):
-            y_size = ceil(y_size * (y_resize_ratio / x_resize_ratio))
-        else:
-            x_size = ceil(x_size * (x_resize_ratio / y_resize_ratio))
-
-        img = img_orig.resize((x_size, y_size), Image.ANTIALIAS)
-        canvas = Image.new("RGB", size, "white")
-        canvas.paste(img, ((size[0]-x_size)//2, (size[1]-y_size)//2))
+        canvas = Image.new("RGB", canvas_size, "white")
+        canvas.paste(img, ((canvas_size[0]-img.size[0])//2, (canvas_size[1]-img.size[1])//2))
 
         result = {
-            "width": img_orig.size[0],
-            "height": img_orig.size[1],
+            "width": width,
+            "height": height,
             "filesize": filesize,
             "canvas": canvas,
             "filename":filename
@@ -115,74 +165,167 @@ class AsyncCanvasLoader:
         return result
 
 class BackgroundCacher:
-    def __init__(self, reader, writer, num_workers, max_cache_size):
-        self.default_worker = AsyncCanvasLoader()
-        workers = []
+    def __init__(self, reader, writer, num_workers, max_cache_bytes, slabs):
+        self.slabs = slabs
+        self.free_slots = list(range(0, slabs.num_slots))
+
+        # Encoding and saving thumbnails happens in its own process, so a
+        # loader is free for the next fetch as soon as it sends its result.
+        self.thumbnail_queue = mp.Queue()
+        self.thumbnail_writer = mp.Process(target=thumbnails.store_in_background,
+            args=(self.thumbnail_queue,))
+        self.thumbnail_writer.start()
+
+        self.default_worker = AsyncCanvasLoader(slabs, self.thumbnail_queue)
+        self.workers = []
         for i in range(0, num_workers):
-            workers.append(AsyncCanvasLoader())
+            self.workers.append(AsyncCanvasLoader(slabs, self.thumbnail_queue))
 
-        self.max_cache_size = max_cache_size
+        self.max_cache_bytes = max_cache_bytes
         self.writer = writer
         self.reader = reader
 
         # Pending cache should have the most important file on the right
         # Since they are cached from right to left.
         self.pending_cache = []
-        self.requested_at = {}
-        self.cache = {}
+        # The last preload request, most important last, and where each file
+        # is in it.
+        self.wanted = []
+        self.wanted_rank = {}
+        # Least recently requested first, so touching and evicting are O(1).
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.fetched = deque(maxlen=pinned_fetches)
+        # Fetched files that aren't loaded yet, oldest request first. They go
+        # before any preload, and the default worker only takes these.
+        self.urgent = deque()
+        # Number of fetches waiting for each file that is being loaded.
+        self.waiting = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.cancelled = 0
+        self.evictions = 0
 
         self.running = True
-        self.active_workers = 0
 
         while self.running:
-            if reader.poll():
-                self.process_input()
+            self.assign_jobs()
 
-            for worker in workers:
-                if worker.is_idle() and len(self.pending_cache) > 0:
-                    self.active_workers = self.active_workers + 1
-                    target = self.suggest_uncached_file()
-                    if target is not None:
-                        worker.set_job(target)
+            # Sleep until there is a message or a worker finishes. Fetches
+            # are answered when their load finishes, so other messages and
+            # results are handled in the meantime.
+            busy = [w.reader for w in self.all_workers() if not w.is_idle()]
+            for conn in wait([reader] + busy):
+                if conn is reader:
+                    self.process_input()
 
+            for worker in self.all_workers():
                 if worker.has_result():
-                    res = worker.get_result()
-                    self.cache[res["filename"]] = res
-                    self.active_workers = self.active_workers - 1
-
-            while len(self.cache) > self.max_cache_size:
-                oldest_time = float("inf")
-                oldest_filename = None
-
-                for path, request_time in self.requested_at.items():
-                    if path in self.cache and request_time < oldest_time:
-                        oldest_time = request_time
-                        oldest_filename = path
-
-                if oldest_filename is not None:
-                    del self.cache[oldest_filename]
-                    del self.requested_at[oldest_filename]
+                    self.store(worker)
 
-            if self.done_caching():
-                time.sleep(0.0001)
+            while self.cache_bytes > self.max_cache_bytes:
+                if not self.evict():
+                    break
 
-        for worker in workers:
+        for worker in self.workers:
             worker.quit()
 
         self.default_worker.quit()
+
+        # Thumbnails still queued are saved before the writer stops.
+        self.thumbnail_queue.put(None)
+        self.thumbnail_writer.join()
         print("Done Cleanup..")
 
-    def suggest_uncached_file(self):
-        target = None
-        while target is None and len(self.pending_cache) > 0:
+    def all_workers(self):
+        return [self.default_worker] + self.workers
+
+    def assign_jobs(self):
+        for worker in self.all_workers():
+            if not worker.is_idle():
+                continue
+
+            target, urgent = self.suggest_uncached_file(worker is not self.default_worker)
+            if target is None:
+                continue
+
+            slot = self.take_slot()
+            if slot is None:
+                if urgent:
+                    self.urgent.appendleft(target)
+                else:
+                    self.pending_cache.append(target)
+                break
+            worker.set_job(target, slot)
+
+    def store(self, worker):
+        filename = worker.job
+        slot = worker.slot
+        res = worker.get_result()
+        if res is not None:
+            self.cache[filename] = res
+            self.cache_bytes = self.cache_bytes + canvas_bytes
+            # Preloaded files arrive most important first, but should be
+            # evicted least important first.
+            rank = self.wanted_rank.get(filename)
+            if rank is not None:
+                for f in self.wanted[rank + 1:]:
+                    if f in self.cache:
+                        self.cache.move_to_end(f)
+            elif not filename in self.waiting and not filename in self.fetched:
+                # Loaded for a preload that has since been replaced, so it is
+                # the first to go.
+                self.cache.move_to_end(filename, last=False)
+        else:
+            self.free_slots.append(slot)
+
+        for i in range(self.waiting.pop(filename, 0)):
+            self.writer.send({"fetched": filename, "result": res})
+        return res
+
+    def evict(self):
+        # Drops the least recently requested file that isn't pinned, and
+        # returns whether there was one. Only the few pinned files can be
+        # skipped on the way.
+        for filename in self.cache:
+            if not filename in self.fetched:
+                res = self.cache.pop(filename)
+                self.free_slots.append(res["slot"])
+                self.cache_bytes = self.cache_bytes - canvas_bytes
+                self.evictions = self.evictions + 1
+                return True
+        return False
+
+    def take_slot(self):
+        if len(self.free_slots) == 0 and not self.evict():
+            return None
+        return self.free_slots.pop()
+
+    def suggest_uncached_file(self, preload):
+        # Returns the next file to load and whether it was fetched.
+        loading = self.loading()
+        while len(self.urgent) > 0:
+            temp = self.urgent.popleft()
+            if not temp in self.cache and not temp in loading:
+                return temp, True
+
+        while preload and len(self.pending_cache) > 0:
             temp = self.pending_cache.pop()
-            if not temp in self.cache:
-                target = temp
+            if not temp in self.cache and not temp in loading:
+                return temp, False
+
+        return None, False
 
-        return target
+    def loading(self):
+        return set(w.job for w in self.all_workers() if not w.is_idle())
+
+    def active_workers(self):
+        return sum(1 for w in self.all_workers() if not w.is_idle())
 
     def done_caching(self):
-        return len(self.pending_cache) == 0 and self.active_workers == 0
+        return len(self.pending_cache) == 0 and len(self.urgent) == 0 and self.active_workers() == 0
 
     def process_input(self):
         msg = self.reader.recv()
@@ -191,73 +334,111 @@ class BackgroundCacher:
             self.running = False
         elif "fetch" in msg:
             filename = msg["fetch"]
-            if not filename in self.cache:
-                self.default_worker.set_job(filename)
-                while not self.default_worker.has_result():
-                    time.sleep(0.0001)
-
-                res = self.default_worker.get_result()
-                self.cache[filename] = res
-                self.requested_at[filename] = time.monotonic()
-                self.writer.send(res)
+            self.fetched.append(filename)
+            if filename in self.cache:
+                self.hits = self.hits + 1
+                self.cache.move_to_end(filename)
+                self.writer.send({"fetched": filename, "result": self.cache[filename]})
             else:
-                self.writer.send(self.cache[filename])
+                # Wait for the load already under way if there is one,
+                # rather than decoding the file twice.
+                if filename in self.loading():
+                    self.joined = self.joined + 1
+                elif not filename in self.waiting:
+                    self.misses = self.misses + 1
+                    self.urgent.append(filename)
+                self.waiting[filename] = self.waiting.get(filename, 0) + 1
 
         elif "preload" in msg:
-            self.pending_cache = msg["preload"]
+            # Most important last, so it ends up the most recently requested.
+            # Queued files that are no longer wanted are dropped.
+            self.wanted = list(msg["preload"])
+            self.wanted_rank = dict((f, i) for i, f in enumerate(self.wanted))
             for f in self.pending_cache:
-                self.requested_at[f] = time.monotonic()
+                if not f in self.wanted_rank:
+                    self.cancelled = self.cancelled + 1
+            self.pending_cache = msg["preload"]
+            for f in self.wanted:
+                if f in self.cache:
+                    self.cache.move_to_end(f)
 
         elif "check_status" in msg:
             status_dict = {
-                "workers_running": self.active_workers,
+                "workers_running": self.active_workers(),
                 "pending_cache": len(self.pending_cache),
                 "cache_size": len(self.cache),
-                "cache_remaining": self.max_cache_size - len(self.cache),
+                "cache_bytes": self.cache_bytes,
+                "cache_remaining": self.max_cache_bytes - self.cache_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "joined": self.joined,
+                "cancelled": self.cancelled,
+                "evictions": self.evictions,
                 "done_caching": self.done_caching()
             }
             self.writer.send(status_dict)
 
-def background_cacher(worker_reader, worker_writer, num_workers, max_cache_size):
+def background_cacher(worker_reader, worker_writer, num_workers, max_cache_bytes, slabs):
     try:
         b = BackgroundCacher(
-            worker_reader, worker_writer, num_workers, max_cache_size
+            worker_reader, worker_writer, num_workers, max_cache_bytes, slabs
         )
     except Exception as e:
         logger.error("".join(traceback.format_exception(*sys.exc_info())))
 
 class ImageCache:
-    def __init__(self, num_workers, max_cache_size=32):
+    def __init__(self, num_workers, max_cache_bytes=default_cache_bytes):
         (self.reader, worker_writer) = mp.Pipe(duplex=False)
         (worker_reader, self.writer) = mp.Pipe(duplex=False)
         self.worker_writer = worker_writer
 
+        # Every cached file and every loader's job holds a slot.
+        self.max_cache_bytes = max_cache_bytes
+        self.slabs = CanvasSlabs(self.capacity() + num_workers + 1)
+
         self.fetcher = mp.Process(target=background_cacher, args=(
-            worker_reader, worker_writer, num_workers, max_cache_size
+            worker_reader, worker_writer, num_workers, max_cache_bytes, self.slabs
         ))
 
         self.fetcher.start()
 
     def fetch(self, path):
-        self.writer.send({"fetch": path})
-        return self.reader.recv()
+        # The canvas is a view of shared memory, valid until a few more files
+        # have been fetched.
+        return self.fetch_all([path])[0]
+
+    def fetch_all(self, paths):
+        # Requests all paths before waiting, so uncached ones load in
+        # parallel. Results come back in the order of paths.
+        for path in set(paths):
+            self.writer.send({"fetch": path})
+
+        results = {}
+        while len(results) < len(set(paths)):
+            msg = self.reader.recv()
+            res = msg["result"]
+            if res is not None:
+                res["canvas"] = self.slabs.canvas(res["slot"])
+            results[msg["fetched"]] = res
+
+        return [results[path] for path in paths]
+
+    def capacity(self):
+        # How many canvases the cache holds before it starts evicting.
+        return max(self.max_cache_bytes // canvas_bytes, pinned_fetches)
 
     def preload(self, paths):
         self.writer.send({"preload": paths})
 
     def check_status(self):
         self.writer.send({"check_status":0})
-
-        while not self.reader.poll():
-            time.sleep(0.0001)
-
-        msg = self.reader.recv()
-        return msg
+        return self.reader.recv()
 
     def quit(self):
         self.writer.send({"quit":0})
         print("Waiting for join")
         self.fetcher.join()
+        self.slabs.unlink()
         print("Join successful")
 
 
@@ -265,33 +446,32 @@ def test_canvas_loader(folder):
     files = os.listdir(folder)
     paths = [join(folder, x) for x in files]
 
-    loader = AsyncCanvasLoader()
+    slabs = CanvasSlabs(1)
+    loader = AsyncCanvasLoader(slabs)
 
     for i in range(1, 5):
         filename = paths[i]
-        loader.set_job(filename)
-        while not loader.has_result():
-            pass
-
-        print("Got the result back in main")
+        loader.set_job(filename, 0)
         res = loader.get_result()
+        print("Got the result back in main")
         pprint(res)
 
     print("Quitting")
     loader.quit()
+    slabs.unlink()
 
 def test_image_cache(folder):
     files = os.listdir(folder)
     paths = [join(folder, x) for x in files]
 
     wanted_size = 20
-    max_cache_size = 30
+    max_cache_bytes = 30 * canvas_bytes
     wanted = paths[:wanted_size]
 
     print("Total paths:",len(paths))
     print("Cached paths:",len(wanted))
 
-    c = ImageCache(num_workers=4, max_cache_size=max_cache_size)
+    c = ImageCache(num_workers=4, max_cache_bytes=max_cache_bytes)
     c.preload(wanted)
 
     while True:
@@ -311,6 +491,21 @@ def test_image_cache(folder):
         res = c.fetch(paths[i])
         print("Fetch time uncached:",time.time() - t0)
 
+    # Uncached pairs load side by side, and a file already being preloaded
+    # is waited on rather than decoded again.
+    for i in range(30, 36, 2):
+        t0 = time.time()
+        left, right = c.fetch_all([paths[i], paths[i + 1]])
+        print("Fetch time uncached pair:",time.time() - t0)
+
+    c.preload(paths[36:38])
+    time.sleep(0.05)
+    t0 = time.time()
+    left, right = c.fetch_all([paths[36], paths[36]])
+    assert left is right
+    print("Fetch time while preloading:",time.time() - t0)
+
+    pprint(c.check_status())
     c.quit()
     print("All processing complete")
 
@@ -0,0 +1,512 @@
+import ctypes
+import os
+import sys
+import time
+import numpy as np
+import similarity
+from similarity import get_summary_size, quantize
+
+# Matches as returned by fast_match, in the layout of its match struct.
+match_dtype = np.dtype([("left", np.int32), ("right", np.int32), ("distance", np.float32)])
+
+# By default only pairs at most this far apart are reported.
+max_dist = 300
+
+# Below this many summaries, building and searching the index costs more
+# than it saves over comparing every pair, most of which the cascade in
+# fast_match rejects on coarse grids.
+index_min_files = 50000
+
+# The index searches on this many principal components of the summaries,
+# which hold most of their variance.
+index_dims = 8
+
+# Rows used to estimate the principal components.
+index_sample_size = 20000
+
+# Peak memory for the distance tiles of the NumPy engine.
+numpy_tile_bytes = 64 * 1024 * 1024
+
+# The NumPy engine computes |a|^2 + |b|^2 - 2a.b in float32, which can be off
+# by this fraction of |a|^2 + |b|^2. Candidates are taken up to that margin
+# past the radius, and every candidate is then checked with a direct
+# difference, which also gives the reported distance.
+numpy_slack = 1e-4
+
+# Version of the fast_match.cpp interface this module calls.
+fast_match_api_version = 2
+
+library_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libfast_match.so")
+
+_fast_match = None
+
+def load_fast_match():
+    # Returns the fast_match library, or None if it hasn't been compiled, was
+    # compiled from an older fast_match.cpp or can't be loaded on this machine.
+    global _fast_match
+    if _fast_match is None:
+        try:
+            lib = ctypes.CDLL(library_path)
+            if lib.fast_match_version() != fast_match_api_version:
+                return None
+        except (OSError, AttributeError) as e:
+            return None
+
+        for name in ["fast_match_search", "fast_match_search_u8"]:
+            getattr(lib, name).restype = ctypes.c_long
+            getattr(lib, name).argtypes = [
+                ctypes.c_void_p, ctypes.c_int, ctypes.c_float, ctypes.c_int,
+                ctypes.POINTER(ctypes.c_void_p)
+            ]
+        for name in ["fast_match_search_index", "fast_match_search_index_u8"]:
+            getattr(lib, name).restype = ctypes.c_long
+            getattr(lib, name).argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+                ctypes.c_float, ctypes.c_int, ctypes.POINTER(ctypes.c_void_p)
+            ]
+        for name in ["fast_match_search_rows", "fast_match_search_rows_u8"]:
+            getattr(lib, name).restype = ctypes.c_long
+            getattr(lib, name).argtypes = [
+                ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                ctypes.c_float, ctypes.POINTER(ctypes.c_void_p)
+            ]
+        lib.fast_match_stats.restype = None
+        lib.fast_match_stats.argtypes = [ctypes.POINTER(ctypes.c_longlong)]
+        lib.fast_match_free.restype = None
+        lib.fast_match_free.argtypes = [ctypes.c_void_p]
+
+        if lib.fast_match_summary_size() != get_summary_size():
+            return None
+
+        _fast_match = lib
+    return _fast_match
+
+def summary_matrix(files, summaries, quantized=None):
+    # Rows in the same order as files, as one contiguous float32 block, or
+    # uint8 for quantized summaries. Summaries cached in the other form are
+    # converted.
+    if quantized is None:
+        quantized = similarity.quantize_summaries
+
+    matrix = np.empty((len(files), get_summary_size()), dtype=np.uint8 if quantized else np.float32)
+    for i, f in enumerate(files):
+        if quantized:
+            matrix[i] = quantize(summaries[f])
+        else:
+            matrix[i] = summaries[f]
+    return matrix
+
+def principal_coordinates(matrix, dims=index_dims, sample_size=index_sample_size):
+    # Coordinates of each row along the leading principal components. The axes
+    # are orthonormal, so distances between coordinates are lower bounds on
+    # distances between the rows.
+    rng = np.random.RandomState(0)
+    sample = matrix
+    if len(matrix) > sample_size:
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+
+    sample = sample.astype(np.float64)
+    mean = sample.mean(axis=0)
+    centered = sample - mean
+    eigenvalues, eigenvectors = np.linalg.eigh(centered.T.dot(centered))
+    axes = eigenvectors[:, ::-1][:, :dims]
+
+    return np.ascontiguousarray((matrix - mean).dot(axes), dtype=np.float32)
+
+def cascade_stats():
+    # How the pairs compared by the last fast_match search were settled. Most
+    # are rejected on coarse grids of the summaries before the full distance.
+    counts = (ctypes.c_longlong * 6)()
+    load_fast_match().fast_match_stats(counts)
+    return dict(zip(["compared", "coarse", "medium", "full", "abandoned", "matched"], counts))
+
+def report_cascade(stats):
+    print("Compared %d pairs: %d rejected on 2x2 means, %d on 4x4 means, "
+        "%d on full summaries (%d part way through), %d matched" % (
+        stats["compared"], stats["coarse"], stats["medium"], stats["full"],
+        stats["abandoned"], stats["matched"]))
+
+def fast_match_pairs(matrix, radius=max_dist, use_index=None, rows=None, report=False, k=None):
+    # All pairs of rows closer than radius, found by fast_match without
+    # copying the matrix. The index gives exactly the same pairs as comparing
+    # every pair and is used for large inputs unless use_index is set.
+    # With rows, only pairs involving at least one of those rows are found.
+    # With k, only pairs where one row is among the k nearest of the other.
+    # A uint8 matrix is compared with the quantized kernels.
+    if k is not None and rows is not None:
+        raise ValueError("Nearest neighbours can't be found for only some rows")
+    lib = load_fast_match()
+    if matrix.dtype == np.uint8:
+        matrix = np.ascontiguousarray(matrix)
+        search = lib.fast_match_search_u8
+        search_rows = lib.fast_match_search_rows_u8
+        search_index = lib.fast_match_search_index_u8
+    else:
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        search = lib.fast_match_search
+        search_rows = lib.fast_match_search_rows
+        search_index = lib.fast_match_search_index
+
+    if use_index is None:
+        use_index = len(matrix) >= index_min_files
+
+    results = ctypes.c_void_p()
+    if rows is not None:
+        rows = np.ascontiguousarray(np.unique(rows), dtype=np.int32)
+        count = search_rows(matrix.ctypes.data, len(matrix),
+            rows.ctypes.data, len(rows), radius, ctypes.byref(results))
+    elif use_index and len(matrix) > 0:
+        coords = principal_coordinates(matrix)
+        count = search_index(matrix.ctypes.data, coords.ctypes.data,
+            coords.shape[1], len(matrix), radius, k or 0, ctypes.byref(results))
+    else:
+        count = search(matrix.ctypes.data, len(matrix), radius, k or 0, ctypes.byref(results))
+
+    try:
+        buffer = (ctypes.c_char * (count * match_dtype.itemsize)).from_address(results.value)
+        matches = np.frombuffer(buffer, dtype=match_dtype).copy()
+    finally:
+        lib.fast_match_free(results)
+
+    if report:
+        report_cascade(cascade_stats())
+    return matches
+
+def numpy_tile_size(tile_bytes=numpy_tile_bytes):
+    # A tile needs about four float32 temporaries of tile_size^2 values.
+    return max(64, int(np.sqrt(tile_bytes / (4 * 4))))
+
+def tile_matches(left, right, left_squares, right_squares, threshold, radius, mask=None):
+    # Pairs (row in left, row in right) closer than radius, as index arrays
+    # and exact distances. mask, if given, marks which pairs may be reported.
+    dists = left.dot(right.T)
+    dists *= -2
+    dists += left_squares[:, np.newaxis]
+    dists += right_squares[np.newaxis, :]
+
+    candidates = dists < threshold
+    if mask is not None:
+        candidates &= mask
+
+    ii, jj = np.nonzero(candidates)
+    exact = exact_distances(left, right, ii, jj)
+    keep = exact < radius
+    return ii[keep], jj[keep], exact[keep]
+
+def exact_distances(left, right, ii, jj):
+    # Distances from left[ii] to right[jj] by direct difference. Pairs are
+    # taken a chunk at a time, since when most of a tile is within the radius
+    # their differences would take far more memory than the tile.
+    exact = np.empty(len(ii), dtype=np.float64)
+    # Both gathered rows, their difference and its float64 copy.
+    chunk = max(1, numpy_tile_bytes // (20 * left.shape[1]))
+    for c0 in range(0, len(ii), chunk):
+        diff = left[ii[c0:c0 + chunk]] - right[jj[c0:c0 + chunk]]
+        exact[c0:c0 + chunk] = np.sqrt(np.einsum("ij,ij->i", diff, diff, dtype=np.float64))
+    return exact
+
+def to_matches(left, right, distance):
+    found = np.zeros(len(left), dtype=match_dtype)
+    found["left"] = left
+    found["right"] = right
+    found["distance"] = distance
+    return found
+
+def concatenate_matches(results):
+    if len(results) == 0:
+        return np.zeros(0, dtype=match_dtype)
+    return np.concatenate(results)
+
+def numpy_pairs(matrix, radius=max_dist, tile_size=None, rows=None, k=None):
+    # Same pairs as fast_match_pairs without the compiled library. Distances
+    # are computed tile by tile with matrix products, so the heavy lifting is
+    # done by BLAS.
+    if k is not None and rows is not None:
+        raise ValueError("Nearest neighbours can't be found for only some rows")
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if tile_size is None:
+        tile_size = numpy_tile_size()
+
+    n = len(matrix)
+    if n == 0:
+        return np.zeros(0, dtype=match_dtype)
+    if rows is not None:
+        return numpy_cross_pairs(matrix, rows, radius, tile_size)
+    if k is not None:
+        return numpy_top_k(matrix, radius, k, tile_size)
+
+    squares = np.einsum("ij,ij->i", matrix, matrix)
+    threshold = radius * radius + numpy_slack * 2 * float(squares.max())
+
+    results = []
+    for i0 in range(0, n, tile_size):
+        i1 = min(i0 + tile_size, n)
+
+        for j0 in range(i0, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+
+            mask = None
+            if i0 == j0:
+                # Each pair once, from the lower index.
+                mask = np.triu(np.ones((i1 - i0, j1 - j0), dtype=bool), 1)
+
+            ii, jj, exact = tile_matches(matrix[i0:i1], matrix[j0:j1],
+                squares[i0:i1], squares[j0:j1], threshold, radius, mask)
+            results.append(to_matches(ii + i0, jj + j0, exact))
+
+    return concatenate_matches(results)
+
+def numpy_cross_pairs(matrix, rows, radius, tile_size):
+    # Pairs between the given rows and every row.
+    n = len(matrix)
+    rows = np.unique(np.asarray(rows, dtype=np.intp))
+    is_row = np.zeros(n, dtype=bool)
+    is_row[rows] = True
+
+    squares = np.einsum("ij,ij->i", matrix, matrix)
+    threshold = radius * radius + numpy_slack * 2 * float(squares.max())
+
+    results = []
+    for k0 in range(0, len(rows), tile_size):
+        query = rows[k0:k0 + tile_size]
+
+        for j0 in range(0, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+            others = np.arange(j0, j1)
+
+            # Pairs of two query rows are reported once, from the lower index.
+            mask = ~is_row[np.newaxis, j0:j1] | (others[np.newaxis, :] > query[:, np.newaxis])
+
+            ii, jj, exact = tile_matches(matrix[query], matrix[j0:j1],
+                squares[query], squares[j0:j1], threshold, radius, mask)
+            left = query[ii]
+            right = jj + j0
+            results.append(to_matches(np.minimum(left, right), np.maximum(left, right), exact))
+
+    return concatenate_matches(results)
+
+def numpy_top_k(matrix, radius, k, tile_size):
+    # Pairs where one row is among the k nearest of the other. Each block of
+    # rows keeps only its k best candidates between tiles, so memory doesn't
+    # depend on how many pairs are within the radius. Candidates are ranked by
+    # the matrix product distances, so near ties can go differently than in
+    # fast_match.
+    n = len(matrix)
+    squares = np.einsum("ij,ij->i", matrix, matrix)
+    threshold = radius * radius + numpy_slack * 2 * float(squares.max())
+
+    results = []
+    for i0 in range(0, n, tile_size):
+        i1 = min(i0 + tile_size, n)
+        best = np.full((i1 - i0, k), np.inf, dtype=np.float32)
+        best_rows = np.zeros((i1 - i0, k), dtype=np.intp)
+
+        for j0 in range(0, n, tile_size):
+            j1 = min(j0 + tile_size, n)
+            dists = matrix[i0:i1].dot(matrix[j0:j1].T)
+            dists *= -2
+            dists += squares[i0:i1, np.newaxis]
+            dists += squares[np.newaxis, j0:j1]
+            dists[dists >= threshold] = np.inf
+
+            # A row isn't its own neighbour.
+            own = np.arange(max(i0, j0), min(i1, j1))
+            dists[own - i0, own - j0] = np.inf
+
+            candidates = np.concatenate([best, dists], axis=1)
+            candidate_rows = np.concatenate([best_rows,
+                np.broadcast_to(np.arange(j0, j1), dists.shape)], axis=1)
+            keep = np.argpartition(candidates, k - 1, axis=1)[:, :k]
+            best = np.take_along_axis(candidates, keep, axis=1)
+            best_rows = np.take_along_axis(candidate_rows, keep, axis=1)
+
+        ii, kk = np.nonzero(np.isfinite(best))
+        left = ii + i0
+        right = best_rows[ii, kk]
+        exact = exact_distances(matrix, matrix, left, right)
+        close = exact < radius
+        results.append(to_matches(np.minimum(left, right)[close],
+            np.maximum(left, right)[close], exact[close]))
+
+    # Pairs among the nearest of both rows are found twice.
+    matches = concatenate_matches(results)
+    keys = matches["left"].astype(np.int64) * n + matches["right"]
+    unique, first = np.unique(keys, return_index=True)
+    return matches[first]
+
+def match_pairs(matrix, radius=max_dist, engine=None, rows=None, report=False, k=None):
+    # Uses fast_match when it is compiled for this machine, otherwise NumPy.
+    # With rows, only pairs involving at least one of those rows are found.
+    # With k, only pairs where one image is among the k nearest of the other.
+    # report prints how many pairs fast_match rejected at each stage.
+    if k is not None and k < 1:
+        raise ValueError("k must be at least 1, got %d" % (k))
+    if engine is None:
+        if load_fast_match() is not None:
+            engine = "fast_match"
+        else:
+            engine = "numpy"
+
+    if engine == "fast_match":
+        return fast_match_pairs(matrix, radius, rows=rows, report=report, k=k)
+    elif engine == "numpy":
+        return numpy_pairs(matrix, radius, rows=rows, k=k)
+    else:
+        raise ValueError("Unknown matching engine: %s" % (engine))
+
+def pair_set(matches):
+    return set(zip(matches["left"].tolist(), matches["right"].tolist()))
+
+def synthetic_summaries(num_files, seed=0, duplicate_fraction=0.05):
+    # Summary-like vectors built from low frequency colour patterns whose
+    # strength falls off with frequency, as in natural images, plus slightly
+    # perturbed copies as planted duplicates.
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:8, 0:8] / 7.0
+    patterns = []
+    scales = []
+    for fx in range(0, 4):
+        for fy in range(0, 4):
+            wave = np.cos(np.pi * fx * x) * np.cos(np.pi * fy * y)
+            wave = wave / np.linalg.norm(wave) * 8
+            for c in range(0, 3):
+                pattern = np.zeros((8, 8, 3))
+                pattern[:, :, c] = wave
+                patterns.append(pattern.flatten())
+                scales.append(60.0 / (1 + fx + fy) ** 1.5)
+    patterns = np.array(patterns)
+
+    weights = rng.randn(num_files, len(patterns)) * np.array(scales)
+    # The constant patterns set each image's overall colour.
+    brightness = rng.uniform(20, 235, size=(num_files, 1))
+    weights[:, 0:3] = rng.uniform(20, 235, size=(num_files, 3)) * 0.4 + brightness * 0.6
+    matrix = weights.dot(patterns) + rng.randn(num_files, get_summary_size()) * 3
+
+    num_duplicates = int(num_files * duplicate_fraction)
+    originals = rng.randint(0, num_files, size=num_duplicates)
+    targets = rng.randint(0, num_files, size=num_duplicates)
+    matrix[targets] = matrix[originals] + rng.randn(num_duplicates, get_summary_size()) * 8
+
+    return np.clip(matrix, 0, 255).astype(np.float32)
+
+def benchmark_index(sizes=(100000, 500000, 1000000), max_full_scan=100000):
+    # The full scan is only run up to max_full_scan rows. Beyond that its time
+    # is extrapolated from the largest measured run, since it is quadratic.
+    full_scan_rate = None
+    for n in sizes:
+        matrix = synthetic_summaries(n)
+
+        t0 = time.time()
+        indexed = fast_match_pairs(matrix, use_index=True)
+        index_time = time.time() - t0
+
+        if n <= max_full_scan:
+            t0 = time.time()
+            full = fast_match_pairs(matrix, use_index=False)
+            full_time = time.time() - t0
+            full_scan_rate = full_time / (n * n)
+            same = pair_set(full) == pair_set(indexed)
+            print("%d summaries: index %0.2fs, full scan %0.2fs, %d pairs, same pairs: %s" % (
+                n, index_time, full_time, len(indexed), same))
+        elif full_scan_rate is not None:
+            print("%d summaries: index %0.2fs, full scan ~%0.0fs (estimated), %d pairs" % (
+                n, index_time, full_scan_rate * n * n, len(indexed)))
+        else:
+            print("%d summaries: index %0.2fs, %d pairs" % (n, index_time, len(indexed)))
+
+def benchmark_quantization(num_files=20000, num_near=2000, radius=max_dist, band=20):
+    # Compares matches on quantized summaries with matches on the float
+    # summaries they came from. Pairs within band of the radius are the only
+    # ones rounding can move across it, so num_near copies are planted at
+    # around the radius from their originals and reported separately.
+    rng = np.random.RandomState(1)
+    matrix = synthetic_summaries(num_files)
+    noise = rng.randn(num_near, get_summary_size()) * radius / np.sqrt(get_summary_size())
+    noise *= rng.uniform(0.9, 1.1, size=(num_near, 1))
+    near = np.clip(matrix[:num_near] + noise, 0, 255).astype(np.float32)
+    matrix = np.concatenate([matrix, near])
+    quantized = quantize(matrix)
+
+    t0 = time.time()
+    exact = fast_match_pairs(matrix, radius + band, use_index=False)
+    float_time = time.time() - t0
+    t0 = time.time()
+    rounded = fast_match_pairs(quantized, radius + band, use_index=False)
+    quantized_time = time.time() - t0
+
+    exact_distances = dict(((m[0], m[1]), m[2]) for m in exact.tolist())
+    rounded_distances = dict(((m[0], m[1]), m[2]) for m in rounded.tolist())
+    shared = set(exact_distances) & set(rounded_distances)
+    errors = [abs(exact_distances[p] - rounded_distances[p]) for p in shared]
+
+    for name, low in [("all pairs", 0), ("pairs near the threshold", radius - band)]:
+        truth = set(p for p, d in exact_distances.items() if low <= d < radius)
+        found = set(p for p, d in rounded_distances.items() if low <= d < radius)
+        both = len(truth & found)
+        print("%s: %d float, %d quantized, recall %0.4f, precision %0.4f" % (
+            name, len(truth), len(found), both / max(len(truth), 1), both / max(len(found), 1)))
+
+    print("Distance changed by %0.3f on average, %0.3f at most" % (np.mean(errors), np.max(errors)))
+    print("Full scan of %d summaries: float %0.2fs, quantized %0.2fs, memory %dMB vs %dMB" % (
+        len(matrix), float_time, quantized_time, matrix.nbytes // 2**20, quantized.nbytes // 2**20))
+
+def test_quantized_kernels(num_files=3000, radius=max_dist):
+    # Whole-valued summaries give exactly the same pairs either way.
+    matrix = quantize(synthetic_summaries(num_files))
+    for use_index in [False, True]:
+        fast = fast_match_pairs(matrix, radius, use_index=use_index)
+        slow = fast_match_pairs(matrix.astype(np.float32), radius, use_index=use_index)
+        assert pair_set(fast) == pair_set(slow)
+        assert np.allclose(np.sort(fast["distance"]), np.sort(slow["distance"]))
+    print("Quantized kernels agree, %d pairs" % (len(fast)))
+
+def test_top_k(num_files=2000, k=3):
+    # Against the k nearest of each row found by sorting all its distances.
+    matrix = synthetic_summaries(num_files)
+    for radius in [max_dist, 2000]:
+        expected = set()
+        for i in range(0, num_files):
+            row = np.sqrt(((matrix - matrix[i]).astype(np.float64) ** 2).sum(axis=1))
+            row[i] = np.inf
+            for j in np.argsort(row)[:k]:
+                if row[j] < radius:
+                    expected.add((min(i, j), max(i, j)))
+
+        for name, found in [
+                ("full scan", fast_match_pairs(matrix, radius, use_index=False, k=k)),
+                ("index", fast_match_pairs(matrix, radius, use_index=True, k=k)),
+                ("numpy", numpy_pairs(matrix, radius, tile_size=300, k=k))]:
+            assert len(found) == len(pair_set(found)), name
+            assert pair_set(found) == expected, name
+        print("Top %d within %d: %d pairs" % (k, radius, len(expected)))
+
+def test_engines_agree(num_files=5000, radius=max_dist):
+    # Distances are summed in a different order by each engine, so pairs
+    # within rounding error of the radius may fall on either side.
+    matrix = synthetic_summaries(num_files)
+
+    t0 = time.time()
+    fast = fast_match_pairs(matrix, radius)
+    fast_time = time.time() - t0
+
+    t0 = time.time()
+    slow = numpy_pairs(matrix, radius)
+    numpy_time = time.time() - t0
+
+    fast_near = pair_set(fast[np.abs(fast["distance"] - radius) < 1e-2])
+    numpy_near = pair_set(slow[np.abs(slow["distance"] - radius) < 1e-2])
+    differing = pair_set(fast) ^ pair_set(slow)
+    assert differing <= (fast_near | numpy_near), differing
+
+    print("fast_match %0.2fs, numpy %0.2fs, %d pairs, %d differ only by rounding" % (
+        fast_time, numpy_time, len(fast), len(differing)))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "test":
+        test_engines_agree()
+        test_quantized_kernels()
+        test_top_k()
+    elif len(sys.argv) > 1 and sys.argv[1] == "quantization":
+        benchmark_quantization()
+    else:
+        benchmark_index()
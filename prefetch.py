@@ -0,0 +1,101 @@
+# Pages against the direction of travel count as this many times further
+# away, so most of the window goes where the reviewer is heading.
+behind_weight = 3
+
+class PrefetchScheduler:
+    """
+    Picks which pages of results to keep cached around the current one.
+    Pages are ranked by how far they are from the current page, with the
+    recent direction of navigation favoured, and only as many pages as fit
+    in the cache are kept so preloading never pushes out the next page.
+    """
+    def __init__(self, capacity, files_per_page=2):
+        # How many pages fit in the cache at once.
+        self.max_pages = max(capacity // files_per_page, 1)
+        self.page = None
+        # 1 when moving forward, -1 backward, 0 after a jump or at the start.
+        self.direction = 0
+
+    def moved_to(self, page, page_count):
+        # Single steps set the direction, wrapping around at either end.
+        # Anything else is a jump, after which both sides matter equally.
+        if self.page is not None and page_count > 2:
+            step = (page - self.page) % page_count
+            if step == 1:
+                self.direction = 1
+            elif step == page_count - 1:
+                self.direction = -1
+            elif step != 0:
+                self.direction = 0
+        self.page = page
+
+    def cost(self, offset):
+        if self.direction == 0 or offset * self.direction > 0:
+            return abs(offset)
+        return abs(offset) * behind_weight
+
+    def schedule(self, page_count):
+        # Returns pages to keep cached, most important first, starting with
+        # the current one.
+        if self.page is None or page_count == 0:
+            return []
+
+        reach = min(self.max_pages, page_count)
+        offsets = range(-reach, reach + 1)
+        # Ties go forward, since that is how pages are usually reviewed.
+        offsets = sorted(offsets, key=lambda x: (self.cost(x), -x))
+
+        pages = []
+        seen = set()
+        for offset in offsets:
+            page = (self.page + offset) % page_count
+            if not page in seen:
+                seen.add(page)
+                pages.append(page)
+            if len(pages) == reach:
+                break
+        return pages
+
+def test_prefetch_scheduler():
+    s = PrefetchScheduler(capacity=12)
+    assert s.schedule(100) == []
+
+    # The first page is ranked like any other, and the window wraps.
+    s.moved_to(0, 100)
+    pages = s.schedule(100)
+    print("Start:", pages)
+    assert pages[:3] == [0, 1, 99]
+    assert len(pages) == 6
+
+    for page in range(1, 5):
+        s.moved_to(page, 100)
+    pages = s.schedule(100)
+    print("Forward:", pages)
+    assert s.direction == 1
+    assert pages[:3] == [4, 5, 6]
+    assert len([p for p in pages if p > 4]) > len([p for p in pages if p < 4])
+
+    s.moved_to(3, 100)
+    pages = s.schedule(100)
+    print("Backward:", pages)
+    assert pages[:3] == [3, 2, 1]
+
+    s.moved_to(50, 100)
+    pages = s.schedule(100)
+    print("Jump:", pages)
+    assert s.direction == 0
+    assert sorted(pages) == [48, 49, 50, 51, 52, 53]
+
+    # Stepping back over the start wraps around.
+    s.moved_to(0, 100)
+    s.moved_to(99, 100)
+    assert s.direction == -1
+
+    # Fewer pages than fit in the cache.
+    s.moved_to(1, 3)
+    pages = s.schedule(3)
+    print("Short:", pages)
+    assert sorted(pages) == [0, 1, 2]
+
+if __name__ == "__main__":
+    test_prefetch_scheduler()
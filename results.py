@@ -0,0 +1,114 @@
+import sys
+import os
+import csv
+import json
+from PIL import Image
+
+# Matches can be saved instead of reviewed right away, one pair per line
+# with what the review shows about each file, and opened in the review
+# later. The format follows the file's extension, JSON Lines by default.
+result_formats = ["jsonl", "csv"]
+result_fields = ["distance", "left", "right",
+    "left_width", "left_height", "left_filesize",
+    "right_width", "right_height", "right_filesize"]
+
+def result_format(path, fmt=None):
+    if fmt is not None:
+        return fmt
+    if path.lower().endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+def file_info(filename):
+    # (width, height, filesize), with None for whatever can't be read. Only
+    # the image header is read.
+    try:
+        filesize = os.path.getsize(filename)
+    except OSError as e:
+        return (None, None, None)
+    try:
+        with Image.open(filename) as img:
+            return img.size + (filesize,)
+    except Exception as e:
+        return (None, None, filesize)
+
+def result_rows(scores):
+    # Pairs as dicts of result_fields, computed as they are written.
+    info = {}
+    for score in scores:
+        row = [score[0], score[1], score[2]]
+        for f in score[1:3]:
+            if not f in info:
+                info[f] = file_info(f)
+            row.extend(info[f])
+        yield dict(zip(result_fields, row))
+
+def write_results(scores, path, fmt=None):
+    # Writes to stdout when path is "-". Returns the number of pairs.
+    fmt = result_format(path, fmt)
+    if path == "-":
+        out = sys.stdout
+    else:
+        out = open(path, "w", newline="")
+
+    count = 0
+    try:
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=result_fields)
+            writer.writeheader()
+        for row in result_rows(scores):
+            if fmt == "csv":
+                writer.writerow(row)
+            else:
+                out.write(json.dumps(row) + "\n")
+            count = count + 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
+    return count
+
+def read_results(path, fmt=None):
+    # Scores as the review takes them, [distance, left, right]. Without fmt,
+    # a file starting with the CSV header is read as CSV whatever its name.
+    scores = []
+    with open(path, newline="") as f:
+        if fmt is None and f.readline().rstrip("\r\n") == ",".join(result_fields):
+            fmt = "csv"
+        fmt = result_format(path, fmt)
+        f.seek(0)
+        if fmt == "csv":
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip() != "")
+        for row in rows:
+            scores.append([float(row["distance"]), row["left"], row["right"]])
+    return scores
+
+def test_results(folder):
+    paths = sorted(os.path.join(folder, x) for x in os.listdir(folder))[:4]
+    scores = [[0.0, paths[0], paths[1]], [12.5, paths[0], paths[2]],
+        [40.25, paths[3], "/missing/file.jpg"]]
+
+    for fmt in result_formats:
+        path = "/tmp/results_test_%d.%s" % (os.getpid(), fmt)
+        assert write_results(scores, path) == len(scores)
+        assert read_results(path) == scores
+        print(fmt, "round trip ok,", os.path.getsize(path), "bytes")
+        os.remove(path)
+
+    # Saved as CSV under another extension.
+    path = "/tmp/results_test_%d.txt" % (os.getpid())
+    write_results(scores, path, "csv")
+    assert read_results(path) == scores
+    assert read_results(path, "csv") == scores
+    os.remove(path)
+
+    rows = list(result_rows(scores))
+    print(rows[2])
+    assert rows[2]["right_filesize"] is None
+    assert rows[0]["left_filesize"] == os.path.getsize(paths[0])
+
+if __name__ == "__main__":
+    test_results(sys.argv[1])
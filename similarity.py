@@ -1,36 +1,105 @@
-from scipy import misc
-from PIL import Image
+from PIL import Image, ExifTags
+from io import BytesIO
 import numpy as np
 import math
 from math import floor
-import signal
-import errno
-from functools import wraps
 import os
+import time
+
+# Summaries only need enough pixels to resolve the 8x8 grid, so images are
+# decoded at the smallest scale that keeps both sides at least this long.
+# Files that can't be decoded at a smaller scale (not JPEG, or JPEGs under
+# twice this size) are summarized at full resolution, exactly as before.
+# Scaled decodes of multi-megapixel JPEGs are within a distance of about 7 of
+# the full resolution summaries, and JPEGs around 1000 pixels wide within
+# about 12 for hard edged content, below the 50 of a typical resize.
+# Embedded EXIF thumbnails add a little more error.
+summary_min_side = 128
+
+# Images that would still need more than this many pixels decoded after
+# scaling are refused, which bounds decode memory at about 4 bytes per pixel.
+max_decode_pixels = 64 * 1024 * 1024
+
+# Summaries can be rounded to whole values and kept as uint8, a quarter of
+# the memory of float32, which fast_match compares with integer SIMD.
+# Rounding moves distances by about 0.3 on average and rarely more than 2,
+# so only pairs right at the match threshold can change (see
+# matching.benchmark_quantization).
+quantize_summaries = False
+
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+
+def exif_thumbnail(img, min_side):
+    # Returns the embedded EXIF thumbnail when it is big enough and has the
+    # same aspect ratio as the image (letterboxed thumbnails would shift the
+    # grid), otherwise None.
+    raw = img.info.get("exif")
+    if not raw or not raw.startswith(b"Exif\x00\x00"):
+        return None
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-
-        return wraps(func)(wrapper)
+    try:
+        ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset = ifd1.get(EXIF_THUMBNAIL_OFFSET)
+        length = ifd1.get(EXIF_THUMBNAIL_LENGTH)
+        if offset is None or length is None:
+            return None
+
+        # Offsets are relative to the TIFF header after the "Exif" marker.
+        data = raw[6 + offset:6 + offset + length]
+        thumb = Image.open(BytesIO(data))
+        thumb.load()
+    except Exception as e:
+        return None
 
-    return decorator
+    width, height = img.size
+    thumb_width, thumb_height = thumb.size
+    if thumb_width < min_side or thumb_height < min_side:
+        return None
+    if abs(thumb_width * height - thumb_height * width) > max(width, height):
+        return None
 
-@timeout(10)
-def load_image(filename):
-    # Load with alpha channel to prevent possible error on transparent images.
-    im = misc.imread(filename, flatten=False, mode='RGBA')
-    return im
+    return thumb
+
+def load_image(filename, min_side=summary_min_side, max_pixels=max_decode_pixels):
+    # Passing min_side=None decodes at full resolution.
+    with Image.open(filename) as img:
+        width, height = img.size
+
+        if min_side is not None:
+            thumb = exif_thumbnail(img, min_side)
+            if thumb is not None:
+                img = thumb
+            elif img.format in ("JPEG", "MPO"):
+                # Lets libjpeg skip DCT coefficients, decoding at 1/2, 1/4 or
+                # 1/8 scale while staying at least the requested size.
+                scale = max(1, min(width, height) // min_side)
+                img.draft("RGB", (width // scale, height // scale))
+
+        if img.size[0] * img.size[1] > max_pixels:
+            raise OSError("%s needs %dx%d pixels decoded, over the budget of %d" % (
+                filename, img.size[0], img.size[1], max_pixels))
+
+        # Images that were decoded at full size are summarized from every
+        # pixel, exactly as with min_side=None.
+        reduced = min_side is not None and img.size != (width, height)
+
+        # Load with alpha channel to prevent possible error on transparent images.
+        # RGB can be scaled first, which avoids converting every source pixel.
+        if not reduced or img.mode != "RGB":
+            img = img.convert("RGBA")
+
+        if reduced:
+            # A scaled decode is already approximate. Box filtering it to a
+            # whole number of pixels per bucket makes the buckets cover equal
+            # fractions of the image, which is close to the full resolution
+            # buckets when there are thousands of pixels per side.
+            side = min_side - min_side % x_buckets
+            if img.size[0] > side and img.size[1] > side:
+                img = img.resize((side, side), Image.BOX)
+            img = img.convert("RGBA")
+
+        return np.asarray(img)
 
 def hist_similarity(h1, h2):
     return np.linalg.norm(h1 - h2)
@@ -41,7 +110,22 @@ y_buckets = 8
 def get_summary_size():
     return x_buckets*y_buckets*3
 
-def patch_stats(im, filename):
+def bucket_edges(length, buckets):
+    # Same boundaries as np.array_split: the first (length % buckets) buckets
+    # get one extra pixel.
+    q, r = divmod(length, buckets)
+    sizes = [q + 1] * r + [q] * (buckets - r)
+    edges = np.zeros(buckets + 1, dtype=np.intp)
+    edges[1:] = np.cumsum(sizes)
+    return edges
+
+def quantize(summary):
+    return np.clip(np.rint(summary), 0, 255).astype(np.uint8)
+
+def patch_stats(im, filename, quantized=None):
+    if quantized is None:
+        quantized = quantize_summaries
+
     if(len(im.shape) != 3):
         return None
 
@@ -52,36 +136,70 @@ def patch_stats(im, filename):
         # Tiny images not supported.
         return None
 
-    x_pixels = np.array(range(0, x_high))
-    y_pixels = np.array(range(0, y_high))
-
-    # This is the easiest way to get ranges which are guaranteed to have
-    # roughly equal sizes, even for small images.
-    x_ranges = np.array_split(x_pixels, x_buckets)
-    y_ranges = np.array_split(y_pixels, y_buckets)
+    x_edges = bucket_edges(x_high, x_buckets)
+    y_edges = bucket_edges(y_high, y_buckets)
 
-    cmeans = []
-
-    for x in x_ranges:
-        x0 = x[0]
-        x1 = x[-1]+1
-
-        for y in y_ranges:
-            y0 = y[0]
-            y1 = y[-1]+1
+    # 8-bit channels can be summed exactly in uint32, which is much faster than
+    # widening every pixel to float64.
+    if im.dtype == np.uint8:
+        acc_type = np.uint32
+    else:
+        acc_type = np.float64
 
-            patch_pixels = (x1 - x0) * (y1 - y0)
-            scale = 1/patch_pixels
+    # Sum each band of rows in one contiguous pass, then the column buckets of
+    # the (8, width, channels) result, so every patch sum comes out of numpy
+    # reductions instead of a Python double loop.
+    row_sums = np.stack([im[x0:x1].sum(axis=0, dtype=acc_type)
+        for x0, x1 in zip(x_edges[:-1], x_edges[1:])])
+    patch_sums = np.add.reduceat(row_sums, y_edges[:-1], axis=1, dtype=np.float64)
 
-            patch = im[x0:x1, y0:y1]
+    # Ignoring alpha channel.
+    patch_sums = patch_sums[:, :, :3]
 
-            r_mean = np.mean(patch[:,:,0])
-            g_mean = np.mean(patch[:,:,1])
-            b_mean = np.mean(patch[:,:,2])
-            # Ignoring alpha channel.
+    patch_pixels = np.outer(np.diff(x_edges), np.diff(y_edges))
+    cmeans = patch_sums / patch_pixels[:, :, np.newaxis]
 
-            cmeans = cmeans + [r_mean, g_mean, b_mean]
-
-    arr_of_hist = np.array(cmeans).flatten()
+    arr_of_hist = cmeans.flatten()
+    if quantized:
+        return quantize(arr_of_hist)
     return arr_of_hist
 
+def _loop_patch_stats(im):
+    # The original per-patch implementation, kept as a reference for
+    # benchmark_patch_stats.
+    x_ranges = np.array_split(np.arange(im.shape[0]), x_buckets)
+    y_ranges = np.array_split(np.arange(im.shape[1]), y_buckets)
+
+    cmeans = []
+    for x in x_ranges:
+        for y in y_ranges:
+            patch = im[x[0]:x[-1]+1, y[0]:y[-1]+1]
+            cmeans.append(np.mean(patch[:,:,0]))
+            cmeans.append(np.mean(patch[:,:,1]))
+            cmeans.append(np.mean(patch[:,:,2]))
+    return np.array(cmeans)
+
+def benchmark_patch_stats(shape=(3000, 4000, 4), repeats=5):
+    rng = np.random.RandomState(0)
+    im = rng.randint(0, 256, size=shape).astype(np.uint8)
+
+    expected = _loop_patch_stats(im)
+    actual = patch_stats(im, None)
+    print("Max difference from loop version:", np.max(np.abs(expected - actual)))
+
+    t0 = time.time()
+    for i in range(0, repeats):
+        _loop_patch_stats(im)
+    loop_time = (time.time() - t0) / repeats
+
+    t0 = time.time()
+    for i in range(0, repeats):
+        patch_stats(im, None)
+    vector_time = (time.time() - t0) / repeats
+
+    print("Loop patch_stats: %0.3f ms" % (loop_time * 1000.0))
+    print("Vectorized patch_stats: %0.3f ms" % (vector_time * 1000.0))
+    print("Speedup: %0.1fx" % (loop_time / vector_time))
+
+if __name__ == "__main__":
+    benchmark_patch_stats()
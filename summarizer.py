@@ -0,0 +1,216 @@
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from collections import deque
+from PIL import Image
+import os
+import signal
+import time
+from similarity import load_image, patch_stats
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# A worker that spends longer than this on one file is killed, and the file
+# is recorded as bad.
+file_timeout = 10
+
+# Memory a worker may allocate on top of what it inherited. Decoding beyond
+# it raises MemoryError, so the file is recorded as bad.
+worker_memory_limit = 1024 * 1024 * 1024
+
+# Memory a worker typically uses while decoding a large photo. The limit
+# above is only a cap on address space, so it isn't what workers need.
+worker_memory_estimate = 256 * 1024 * 1024
+
+# Workers are started by a server process instead of being forked from the
+# scan, which has its walker and cache writer threads running. A forked
+# worker could inherit a lock one of those threads was holding.
+if "forkserver" in mp.get_all_start_methods():
+    worker_context = mp.get_context("forkserver")
+else:
+    worker_context = mp.get_context("spawn")
+
+def get_summary(f):
+    try:
+        return patch_stats(load_image(f), f)
+    except (OSError, MemoryError, Image.DecompressionBombError) as e:
+        #~ print("OSError accessing ",f)
+        return None
+
+def available_memory():
+    # MemAvailable counts page cache that can be reclaimed, which after
+    # reading a large library is most of the memory that isn't MemFree.
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) as e:
+        pass
+    return None
+
+def default_num_workers(memory_estimate=worker_memory_estimate):
+    # One worker per usable core, as long as there is memory for each.
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError as e:
+        cores = os.cpu_count() or 1
+
+    memory = available_memory()
+    if memory is not None:
+        cores = min(cores, memory // memory_estimate)
+    return max(1, cores)
+
+def limit_memory(memory_limit):
+    if resource is None:
+        return
+    try:
+        with open("/proc/self/statm") as statm:
+            inherited = int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+        limit = inherited + memory_limit
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (OSError, ValueError) as e:
+        pass
+
+def summary_worker(conn, memory_limit):
+    # The main process decides what to do about Ctrl-C.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    limit_memory(memory_limit)
+
+    while True:
+        files = conn.recv()
+        if files is None:
+            break
+        for f in files:
+            conn.send((f, get_summary(f)))
+
+class SummaryWorker:
+    def __init__(self, memory_limit):
+        self.conn, worker_conn = worker_context.Pipe()
+        self.process = worker_context.Process(target=summary_worker, args=(worker_conn, memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        worker_conn.close()
+
+        # Files sent and not answered yet, the first is being worked on.
+        self.files = deque()
+        self.started = None
+
+    def send(self, files):
+        self.files.extend(files)
+        self.started = time.monotonic()
+        self.conn.send(files)
+
+    def receive(self):
+        # Results that have arrived, without blocking. Raises EOFError if the
+        # worker died.
+        results = []
+        while len(self.files) > 0 and self.conn.poll():
+            results.append(self.conn.recv())
+            self.files.popleft()
+            self.started = time.monotonic()
+        return results
+
+    def quit(self):
+        try:
+            self.conn.send(None)
+        except OSError as e:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class SummaryPool:
+    """
+    Summarizes files in worker processes. Each worker gets a chunk of files
+    and reports back after each one, so a supervisor in the calling process
+    can see when a worker hangs or dies on a file. That worker is killed and
+    replaced, the file is reported as bad, and the rest of its chunk goes
+    back in the queue.
+    """
+
+    def __init__(self, num_workers=None, timeout=file_timeout, memory_limit=worker_memory_limit):
+        if num_workers is None:
+            num_workers = default_num_workers()
+
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.queue = deque()
+        self.workers = [SummaryWorker(memory_limit) for i in range(0, num_workers)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, files):
+        if len(files) > 0:
+            self.queue.append(list(files))
+            self.dispatch()
+
+    def pending(self):
+        # Number of files submitted whose results haven't been collected.
+        return sum(len(c) for c in self.queue) + sum(len(w.files) for w in self.workers)
+
+    def dispatch(self):
+        for worker in self.workers:
+            if len(self.queue) == 0:
+                break
+            if len(worker.files) == 0:
+                worker.send(self.queue.popleft())
+
+    def collect(self, timeout=None):
+        # Waits until at least one result is ready (or timeout passes) and
+        # returns a list of (filename, summary). Bad files have summary None.
+        self.dispatch()
+        busy = [w for w in self.workers if len(w.files) > 0]
+        if len(busy) == 0:
+            return []
+
+        now = time.monotonic()
+        wait_time = max(0, min(w.started for w in busy) + self.timeout - now)
+        if timeout is not None:
+            wait_time = min(wait_time, timeout)
+        wait([w.conn for w in busy] + [w.process.sentinel for w in busy], wait_time)
+
+        results = []
+        for worker in busy:
+            try:
+                results.extend(worker.receive())
+                dead = len(worker.files) > 0 and not worker.process.is_alive()
+            except (EOFError, OSError) as e:
+                dead = True
+
+            hung = len(worker.files) > 0 and time.monotonic() - worker.started > self.timeout
+            if dead or hung:
+                results.extend(self.replace(worker, hung))
+
+        self.dispatch()
+        return results
+
+    def replace(self, worker, hung):
+        bad_file = worker.files.popleft()
+        if hung:
+            print("Timeout accessing ", bad_file)
+        else:
+            print("Worker crashed on ", bad_file)
+
+        rest = list(worker.files)
+        worker.kill()
+        self.workers[self.workers.index(worker)] = SummaryWorker(self.memory_limit)
+        if len(rest) > 0:
+            self.queue.appendleft(rest)
+        return [(bad_file, None)]
+
+    def close(self):
+        for worker in self.workers:
+            worker.quit()
+        self.workers = []
@@ -0,0 +1,243 @@
+import sqlite3
+import hashlib
+import os
+import sys
+import time
+import logging
+import traceback
+import multiprocessing as mp
+from math import ceil
+from os.path import join
+from PIL import Image
+
+# Shares the image cache's log, since this runs in its loader processes.
+logger = logging.getLogger('message_test')
+
+# Review canvases are kept on disk between sessions, so files seen before
+# don't have to be decoded again. Each file has one thumbnail, the image
+# scaled to fit the canvas, saved as lossless WebP so it looks exactly like
+# a freshly decoded one. The index tracks the file's size and mtime, and
+# when each thumbnail was last used.
+thumbnail_dir = "thumbnails"
+thumbnail_format = "WEBP"
+thumbnail_options = {"lossless": True, "method": 0}
+
+# Least recently used thumbnails are deleted once they take up more than
+# this, down to prune_fraction of it.
+max_thumbnail_bytes = 1024 ** 3
+prune_fraction = 0.9
+
+# Loaders share the index, so writers wait for each other this long.
+index_timeout = 30
+
+def connect():
+    os.makedirs(thumbnail_dir, exist_ok=True)
+    conn = sqlite3.connect(join(thumbnail_dir, "index.db"), timeout=index_timeout)
+    c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute('CREATE TABLE IF NOT EXISTS thumbnails(filename text primary key, '
+        'size integer, mtime integer, width integer, height integer, '
+        'bytes integer, used real)')
+    c.execute('CREATE INDEX IF NOT EXISTS thumbnails_used ON thumbnails(used)')
+    return conn
+
+def thumbnail_path(filename):
+    digest = hashlib.blake2b(filename.encode("utf-8", "surrogateescape"),
+        digest_size=16).hexdigest()
+    return join(thumbnail_dir, digest + "." + thumbnail_format.lower())
+
+def fit(width, height, size):
+    # The largest size with the image's aspect ratio that fits in size.
+    x_size = size[0]
+    y_size = size[1]
+    x_resize_ratio = width / x_size
+    y_resize_ratio = height / y_size
+
+    if(x_resize_ratio > y_resize_ratio):
+        y_size = ceil(y_size * (y_resize_ratio / x_resize_ratio))
+    else:
+        x_size = ceil(x_size * (x_resize_ratio / y_resize_ratio))
+    return (x_size, y_size)
+
+def load(filename, st, size):
+    # (image, width, height) of a stored thumbnail that is still valid for
+    # the file's stat and the canvas size, or None.
+    try:
+        conn = connect()
+        c = conn.cursor()
+        c.execute("SELECT size, mtime, width, height FROM thumbnails WHERE filename=?",
+            (filename,))
+        row = c.fetchone()
+        if row is None or row[0:2] != (st.st_size, st.st_mtime_ns):
+            conn.close()
+            return None
+
+        width, height = row[2:4]
+        img = Image.open(thumbnail_path(filename))
+        img.load()
+        if img.size != fit(width, height, size):
+            conn.close()
+            return None
+
+        c.execute("UPDATE thumbnails SET used=? WHERE filename=?", (time.time(), filename))
+        conn.commit()
+        conn.close()
+        return (img, width, height)
+    except FileNotFoundError as e:
+        # Pruned by another loader in the meantime.
+        return None
+    except (sqlite3.Error, OSError) as e:
+        # A damaged thumbnail just means decoding the file again.
+        logger.error("".join(traceback.format_exception(*sys.exc_info())))
+        return None
+
+def store(filename, st, img, width, height):
+    try:
+        # Written under a temporary name first, so a reader never sees half
+        # a thumbnail.
+        path = thumbnail_path(filename)
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        img.save(temp, thumbnail_format, **thumbnail_options)
+        os.replace(temp, path)
+
+        conn = connect()
+        conn.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (filename, st.st_size, st.st_mtime_ns, width, height,
+                os.path.getsize(path), time.time()))
+        conn.commit()
+        prune(conn)
+        conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.error("".join(traceback.format_exception(*sys.exc_info())))
+
+def store_in_background(store_queue):
+    # Saves thumbnails sent as the arguments of store until it gets None, so
+    # the processes that rendered them can go on with other work.
+    while True:
+        args = store_queue.get()
+        if args is None:
+            break
+        try:
+            store(*args)
+        except Exception as e:
+            logger.error("".join(traceback.format_exception(*sys.exc_info())))
+
+def prune(conn, max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_thumbnail_bytes
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(SUM(bytes), 0) FROM thumbnails")
+    total = c.fetchone()[0]
+    if total <= max_bytes:
+        return
+
+    dropped = []
+    c.execute("SELECT filename, bytes FROM thumbnails ORDER BY used")
+    for filename, nbytes in c.fetchall():
+        if total <= max_bytes * prune_fraction:
+            break
+        try:
+            os.remove(thumbnail_path(filename))
+        except FileNotFoundError as e:
+            pass
+        total = total - nbytes
+        dropped.append((filename,))
+
+    c.executemany("DELETE FROM thumbnails WHERE filename=?", dropped)
+    conn.commit()
+
+def render(filename, size, cache=True, later=None):
+    # The image scaled to fit size, with the original's stats, as
+    # (image, width, height, filesize). Uses the stored thumbnail when there
+    # is a valid one, and stores a new one otherwise if cache is set. Given a
+    # list as later, the arguments for store are added to it instead, so the
+    # caller can save the thumbnail after using the image.
+    st = os.stat(filename)
+    if cache:
+        found = load(filename, st, size)
+        if found is not None:
+            return found + (st.st_size,)
+
+    img_orig = Image.open(filename)
+    width, height = img_orig.size
+    img = img_orig.resize(fit(width, height, size), Image.LANCZOS)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    if cache and later is not None:
+        later.append((filename, st, img, width, height))
+    elif cache:
+        store(filename, st, img, width, height)
+    return (img, width, height, st.st_size)
+
+def render_quietly(args):
+    filename, size = args
+    try:
+        render(filename, size)
+        return True
+    except Exception as e:
+        logger.error("".join(traceback.format_exception(*sys.exc_info())))
+        return False
+
+def fill(files, size, num_workers):
+    # Renders thumbnails of files in the background ahead of a review, the
+    # first file last so it is the most recently used. Files that already
+    # have one only get marked as used.
+    rendered = 0
+    with mp.Pool(num_workers) as pool:
+        for ok in pool.imap(render_quietly, [(f, size) for f in reversed(files)]):
+            if ok:
+                rendered = rendered + 1
+    return rendered
+
+def test_thumbnails(folder):
+    global thumbnail_dir
+    thumbnail_dir = join("/tmp", "thumbnails_test_%d" % (os.getpid()))
+    paths = sorted(join(folder, x) for x in os.listdir(folder))[:8]
+    size = (600, 600)
+
+    for f in paths:
+        t0 = time.time()
+        fresh = render(f, size)
+        t1 = time.time()
+        stored = render(f, size)
+        t2 = time.time()
+        assert fresh[1:] == stored[1:]
+        assert fresh[0].tobytes() == stored[0].tobytes()
+        print("Decode %.1f ms, thumbnail %.1f ms" % ((t1 - t0) * 1000, (t2 - t1) * 1000))
+
+    # A changed file or canvas size isn't served from the old thumbnail.
+    st = os.stat(paths[0])
+    os.utime(paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert load(paths[0], os.stat(paths[0]), size) is None
+    os.utime(paths[0], ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert load(paths[0], st, (300, 300)) is None
+    assert load(paths[0], st, size) is not None
+
+    # The least recently used go first.
+    conn = connect()
+    prune(conn, max_bytes=1)
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM thumbnails")
+    assert c.fetchone()[0] == 0
+    conn.close()
+    assert [x for x in os.listdir(thumbnail_dir) if x.endswith(".webp")] == []
+
+    for f in paths:
+        render(f, size)
+        time.sleep(0.01)
+    render(paths[0], size)
+    conn = connect()
+    c = conn.cursor()
+    c.execute("SELECT bytes FROM thumbnails")
+    sizes = [x[0] for x in c.fetchall()]
+    prune(conn, max_bytes=sum(sizes) - 1)
+    c.execute("SELECT filename FROM thumbnails")
+    kept = set(x[0] for x in c.fetchall())
+    conn.close()
+    assert paths[0] in kept and not paths[1] in kept
+    print("Kept %d of %d thumbnails after pruning" % (len(kept), len(paths)))
+
+if __name__ == "__main__":
+    test_thumbnails(sys.argv[1])